@@ -0,0 +1,48 @@
+"""
+Benchmark of the related instance instantiation cost per row: keyword
+arguments init (as before) against the positional Model.from_db path.
+
+Run from the repository root with: python benchmarks/instantiation.py
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_app.settings')
+
+import django  # noqa
+django.setup()
+
+from django_group_by.plan import RowPlan  # noqa
+from test_app.models import Author, Book  # noqa
+
+
+ROWS = 100000
+
+# Related columns as expanded for group_by('author') (all fields), and
+# for group_by('author__name') (other fields deferred)
+CASES = (
+    ('all fields', ['author__id', 'author__name', 'author__nationality_id'],
+     (1, 'Terry Pratchett', 2)),
+    ('deferred fields', ['author__name'], ('Terry Pratchett',)),
+)
+
+
+def run():
+    print('Related instance instantiation, {} rows'.format(ROWS))
+    for label, names, row in CASES:
+        target, = RowPlan(Book, names).related
+        kwargs = dict(zip(target.field_names, row))
+
+        before = timeit.timeit(lambda: Author(**kwargs), number=ROWS)
+        after = timeit.timeit(lambda: target.build(row, 'default'), number=ROWS)
+
+        print('{:>16}: kwargs {:.2f} us/row, from_db {:.2f} us/row ({:.1f}x)'.format(
+            label, before / ROWS * 1e6, after / ROWS * 1e6, before / after))
+
+
+if __name__ == '__main__':
+    run()
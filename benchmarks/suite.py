@@ -0,0 +1,305 @@
+"""
+Benchmark suite for the group_by hot paths: field expansion, row decoding
+and grouped query iteration against values(), on a seeded in-memory SQLite
+database with datasets of different sizes, FK depths and widths.
+
+Run from the repository root with: python benchmarks/suite.py
+
+    --rows 10000 100000 1000000   dataset sizes (books) to run
+    --repeat 10                   rounds timing every case (for at least 0.1s), the best is kept
+    --save                        store results as the new baseline
+    --compare                     compare with the baseline, exit 1 on regressions
+
+Query cases report the books scanned per second (the input rows of the
+aggregation), after a warm-up evaluation.
+"""
+from __future__ import division, print_function
+
+import argparse
+import gc
+import json
+import os
+import resource
+import sys
+import time
+import timeit
+from datetime import datetime
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_app.settings')
+
+import django  # noqa
+django.setup()
+
+from django.db import connection  # noqa
+from django.db.models import Count  # noqa
+
+from django_group_by import GroupByMixin  # noqa
+from django_group_by.cache import clear_caches, dimension_cache  # noqa
+from django_group_by.plan import RowPlan  # noqa
+from test_app.models import Author, Book, Nation  # noqa
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Throughput below this fraction of the baseline is reported as regression
+TOLERANCE = 0.7
+
+# Rounds timing every case (best of them), unless given with --repeat, each
+# timing of enough calls to take at least MIN_TIME seconds
+REPEAT = 10
+MIN_TIME = 0.1
+
+# CPU time of the process, so that time the machine spends elsewhere (other
+# processes, or other guests of the host) is not counted
+TIMER = getattr(time, 'process_time', time.clock)
+
+# Grouping cases: name, fields (by FK depth and width of the expansion)
+CASES = (
+    ('own', ('title',)),
+    ('fk', ('author',)),
+    ('deep', ('author', 'author__nationality')),
+    ('wide', ('title', 'publication_date', 'author', 'author__nationality')),
+)
+
+
+def seed(rows):
+    """
+    Replace the dataset: rows books by rows/100 authors from 50 nations, with
+    rows/10 distinct titles.
+    """
+    Book.objects.all().delete()
+    Author.objects.all().delete()
+    Nation.objects.all().delete()
+
+    Nation.objects.bulk_create(Nation(name='Nation {}'.format(i), demonym='Demonym {}'.format(i))
+                               for i in range(50))
+    nations = list(Nation.objects.values_list('id', flat=True))
+    Author.objects.bulk_create(Author(name='Author {}'.format(i), nationality_id=nations[i % 50])
+                               for i in range(max(rows // 100, 1)))
+    authors = list(Author.objects.values_list('id', flat=True))
+
+    date = datetime(2000, 1, 1)
+    titles = max(rows // 10, 1)
+    for start in range(0, rows, 10000):
+        Book.objects.bulk_create(
+            Book(title='Book {}'.format(i % titles), publication_date=date,
+                 author_id=authors[i % len(authors)])
+            for i in range(start, min(start + 10000, rows)))
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS (Linux 4.0+ only), returning the current one in KB.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+    return peak_rss()
+
+
+def peak_rss():
+    """
+    Get the peak RSS in KB, from /proc if available (it can be reset there).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def best_times(funcs, repeat=REPEAT):
+    """
+    Get the best time of a call of every function (by key), out of repeat
+    rounds timing all of them in turn, so that slow periods of the machine
+    don't hit every timing of a case. Each timing is of as many calls as
+    needed to take at least MIN_TIME (doubled until they do), after a
+    warm-up call.
+    """
+    numbers = {}
+    for key, func in funcs.items():
+        func()
+        number = 1
+        while timeit.timeit(func, timer=TIMER, number=number) < MIN_TIME:
+            number *= 2
+        numbers[key] = number
+
+    best = {}
+    for _ in range(repeat):
+        for key, func in funcs.items():
+            elapsed = timeit.timeit(func, timer=TIMER, number=numbers[key]) / numbers[key]
+            best[key] = min(best.get(key, elapsed), elapsed)
+    return best
+
+
+def measure_memory(make_queryset):
+    """
+    Evaluate the queryset, returning its number of rows, memory per row
+    (bytes, if tracemalloc is available) and the growth of the peak RSS (KB).
+    """
+    gc.collect()
+    rss = reset_peak_rss()
+    count = len(list(make_queryset()))
+    rss = peak_rss() - rss
+
+    # Memory in a separate pass, tracing slows everything down
+    per_row = None
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        result = list(make_queryset())
+        per_row = tracemalloc.get_traced_memory()[0] / max(count, 1)
+        tracemalloc.stop()
+        del result
+
+    return {'rows': count, 'bytes_per_row': per_row, 'peak_rss_kb': rss}
+
+
+def bench_queries(rows, repeat=REPEAT):
+    """
+    Grouped query iteration, values() against group_by(), and all joined in
+    SQL against dimension tables (loaded in the warm-up), per case, in books
+    scanned per second.
+    """
+    querysets = {}
+    for name, fields in CASES:
+        expanded = GroupByMixin._expand_group_by_fields(Book, fields)
+        modes = (
+            ('values', lambda e=expanded: Book.objects.values(*e).annotate(Count('id'))),
+            ('group_by', lambda f=fields: Book.objects.group_by(*f).annotate(Count('id'))),
+            ('dimensions', lambda f=fields: Book.objects.group_by(*f, hydrate='dimensions')
+                                                        .annotate(Count('id'))),
+            ('auto', lambda f=fields: Book.objects.group_by(*f, hydrate='auto')
+                                                  .annotate(Count('id'))),
+        )
+        for mode, make_queryset in modes:
+            querysets['{}/{}/{}'.format(name, mode, rows)] = make_queryset
+
+    dimension_cache.clear()
+    results = dict((key, measure_memory(make_queryset))
+                   for key, make_queryset in querysets.items())
+    times = best_times(dict((key, lambda q=make_queryset: list(q()))
+                            for key, make_queryset in querysets.items()), repeat)
+    for key, elapsed in times.items():
+        results[key]['per_sec'] = rows / elapsed
+    return results
+
+
+def bench_hot_paths(repeat=REPEAT):
+    """
+    Field expansion (uncached and cached) and row decoding without database,
+    in calls per second.
+    """
+    funcs = {}
+    for name, fields in CASES:
+        funcs['{}/expand'.format(name)] = partial(GroupByMixin._expand_group_by_fields, Book, fields)
+        funcs['{}/expand_cached'.format(name)] = partial(GroupByMixin._get_group_by_fields, Book, fields)
+
+        # Decode rows like the ones of the query (all values set)
+        names = GroupByMixin._expand_group_by_fields(Book, fields) + ['id__count']
+        decode = RowPlan(Book, names, ['id__count']).decoder('default')
+        funcs['{}/decode'.format(name)] = partial(decode, tuple(range(1, len(names) + 1)))
+
+    clear_caches()
+    return dict((key, {'per_sec': 1 / elapsed}) for key, elapsed in best_times(funcs, repeat).items())
+
+
+def phase(key):
+    """
+    Get the name of the cases timed together with the one of the key: its
+    dataset size, or 'hot paths'.
+    """
+    size = key.rsplit('/', 1)[-1]
+    return '{} rows'.format(size) if size.isdigit() else 'hot paths'
+
+
+def report(results, baseline=None):
+    """
+    Print the results, compared to the baseline if given. Returns the keys
+    of the results that regressed.
+
+    Throughput is compared relative to the median ratio of the cases timed
+    together (the hot paths, or the queries of a dataset size), taken as the
+    speed of the machine against the baseline's, so that a run on a slower
+    (or busier) machine is not reported as regressed as a whole.
+    """
+    ratios = {}
+    if baseline:
+        ratios = dict((key, result['per_sec'] / baseline[key]['per_sec'])
+                      for key, result in results.items()
+                      if 'per_sec' in baseline.get(key, ()))
+    groups = {}
+    for key, ratio in ratios.items():
+        groups.setdefault(phase(key), []).append(ratio)
+    speeds = dict((name, sorted(group)[len(group) // 2]) for name, group in groups.items())
+
+    regressions = []
+    print('{:<32} {:>14} {:>12} {:>12} {:>10}'.format(
+        'case', 'books|calls/s', 'bytes/row', 'rss KB', 'baseline'))
+    for key in sorted(results):
+        result = results[key]
+        per_row = result.get('bytes_per_row')
+        line = '{:<32} {:>14,.0f} {:>12} {:>12}'.format(
+            key, result['per_sec'],
+            '-' if per_row is None else '{:,.0f}'.format(per_row),
+            '{:,}'.format(result['peak_rss_kb']) if 'peak_rss_kb' in result else '-')
+
+        # Throughput against the baseline, at the speed of this run
+        if key in ratios:
+            line += ' {:>9.0%}'.format(ratios[key])
+            if ratios[key] / speeds[phase(key)] < TOLERANCE:
+                line += ' REGRESSION'
+                regressions.append(key)
+        print(line)
+    for name in sorted(speeds):
+        print('Median throughput against the baseline ({}): {:.0%}'.format(name, speeds[name]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--save', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--baseline', default=BASELINE)
+    args = parser.parse_args(argv)
+
+    connection.creation.create_test_db(verbosity=0)
+    results = bench_hot_paths(args.repeat)
+    for rows in args.rows:
+        seed(rows)
+        results.update(bench_queries(rows, args.repeat))
+
+    # Results are only comparable within the same environment
+    environment = {'python': sys.version.split()[0], 'django': django.get_version()}
+    baseline = None
+    if args.compare and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored['environment'] != environment:
+            print('Baseline environment differs: {}'.format(stored['environment']))
+        baseline = stored['results']
+    regressions = report(results, baseline)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'environment': environment, 'results': results}, f,
+                      indent=2, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
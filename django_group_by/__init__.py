@@ -1,4 +1,6 @@
 """
 This module contains the package exports.
 """
-from .mixin import GroupByMixin
+from .batch import group_by_batch
+from .mixin import GroupByMixin, warm_group_by_cache
+from .rows import dict_rows, group_rows, namedtuple_rows, tuple_rows
@@ -0,0 +1,97 @@
+"""
+This module contains the asynchronous iteration support (Python 3.6+), which
+fetches and decodes rows in chunks on a worker thread.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+
+from django.db import connections
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+
+from .options import get_options, set_options
+
+try:
+    # Django 3.0+ ships asgiref, use its thread sensitive sync thread
+    from asgiref.sync import sync_to_async
+
+except ImportError:
+    sync_to_async = None
+
+
+class ThreadRunner(object):
+    """
+    Runs sync functions on a single dedicated thread, so that the database
+    connection (and cursor) used by one iteration stays on that thread.
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def __call__(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args))
+
+    async def close(self):
+        # The thread's connections would be leaked otherwise
+        await self(connections.close_all)
+        self.executor.shutdown(wait=False)
+
+
+class AsgirefRunner(object):
+    """
+    Runs sync functions with asgiref's thread sensitive sync_to_async, like
+    Django's own async queryset methods.
+    """
+    async def __call__(self, func, *args):
+        return await sync_to_async(func, thread_sensitive=True)(*args)
+
+    async def close(self):
+        pass
+
+
+class GroupByAsyncMixin(object):
+    """
+    Mixin that adds async iteration to querysets: rows are fetched and
+    decoded on a worker thread in chunks, and yielded to the event loop.
+    """
+    def __aiter__(self):
+        return self.aiterator()
+
+    async def aiterator(self, chunk_size=None):
+        """
+        Asynchronously iterate the queryset, fetching and decoding rows in
+        chunks of chunk_size (or the chunk_size option) on a worker thread.
+        """
+        # Already evaluated, just yield the cached results
+        if self._result_cache is not None:
+            for obj in self._result_cache:
+                yield obj
+            return
+
+        # Clone with chunked fetching, then pull chunks from a worker thread
+        chunk_size = (chunk_size or get_options(self.query)['chunk_size'] or
+                      GET_ITERATOR_CHUNK_SIZE)
+        clone = self._clone()
+        set_options(clone.query, {'chunk_size': chunk_size})
+        runner = AsgirefRunner() if sync_to_async else ThreadRunner()
+        rows = None
+        try:
+            rows = await runner(clone.iterator)
+            while True:
+                chunk = await runner(list, islice(rows, chunk_size))
+                for obj in chunk:
+                    yield obj
+                if len(chunk) < chunk_size:
+                    break
+        finally:
+            # Close the iterator (and its cursor) on the worker thread too
+            if rows is not None:
+                await runner(getattr(rows, 'close', lambda: None))
+            await runner.close()
+
+    async def alist(self):
+        """
+        Asynchronously evaluate the queryset into a list.
+        """
+        return [obj async for obj in self.aiterator()]
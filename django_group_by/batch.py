@@ -0,0 +1,31 @@
+"""
+This module contains the batched evaluation of independent group_by
+querysets (e.g. the reports of a dashboard page), which are run at the same
+time on separate connections, so that the total time is that of the
+slowest one instead of the sum of all of them.
+"""
+from functools import partial
+
+from .parallel import run_tasks
+
+
+def group_by_batch(querysets, workers=None):
+    """
+    Evaluate the group_by querysets at the same time, each in a thread with
+    its own connection, and get their rows decoded as when iterating them.
+
+    Since every thread uses its own connection, data written in the current
+    transaction is not seen (unless workers is 1, which runs them in turn).
+
+    :param querysets: group_by querysets, of any models and databases
+    :param workers: number of threads, one per queryset if not given
+    :return: list of lists of rows, in the order of the querysets
+    """
+    querysets = list(querysets)
+    for queryset in querysets:
+        # Fail before running any of them
+        queryset._group_by_field_names()
+
+    # Evaluate clones, the querysets' result caches are not touched
+    tasks = [partial(list, queryset.all()) for queryset in querysets]
+    return run_tasks(tasks, workers or len(tasks))
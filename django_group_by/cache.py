@@ -0,0 +1,137 @@
+"""
+This module contains the process-wide caches for expanded group_by fields
+and row plans, which are cleared whenever the app registry changes.
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from django.core.signals import setting_changed
+from django.db.models.signals import class_prepared
+
+
+class LRUCache(object):
+    """
+    Simple thread-safe dictionary bounded to maxsize entries, which evicts
+    the least recently used entry when full.
+    """
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        Get the value for the key (marking it as recently used) or default.
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        """
+        Set the value for the key, evicting the oldest entries if full.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        with self._lock:
+            self._data.clear()
+
+
+class TTLCache(object):
+    """
+    Simple thread-safe dictionary whose entries expire ttl seconds after
+    they are set.
+    """
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._data = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        Get the value for the key, or default if missing or expired.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires <= time.time():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        """
+        Set the value for the key, which expires in ttl seconds.
+        """
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+
+    def delete(self, key):
+        """
+        Remove the entry for the key, if any.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        with self._lock:
+            self._data.clear()
+
+
+# Expanded fields by (model, fields), row plans by (model, names, own names),
+# group classes by (model, attributes) and the models by table name
+fields_cache = LRUCache()
+plan_cache = LRUCache()
+shape_cache = LRUCache()
+tables_cache = LRUCache(maxsize=1)
+
+# Whole dimension tables and table sizes by (kind, model, database)
+dimension_cache = TTLCache()
+
+
+def clear_caches(**kwargs):
+    """
+    Clear all caches, used as receiver of app registry related signals.
+    """
+    fields_cache.clear()
+    plan_cache.clear()
+    shape_cache.clear()
+    tables_cache.clear()
+    dimension_cache.clear()
+
+
+def _installed_apps_changed(setting, **kwargs):
+    if setting == 'INSTALLED_APPS':
+        clear_caches()
+
+
+# New model classes mean the registry was (re)loaded, cached models are stale
+class_prepared.connect(clear_caches, dispatch_uid='django_group_by.cache')
+setting_changed.connect(_installed_apps_changed, dispatch_uid='django_group_by.cache')
@@ -0,0 +1,126 @@
+"""
+This module contains the columnar result mode, which returns one column
+per selected name instead of a grouped object per row.
+"""
+from array import array
+from collections import OrderedDict
+from itertools import islice
+
+from django.core.exceptions import FieldError
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+
+from .fetch import grouped_rows
+from .plan import ROLLUP_LEVEL, RowPlan, resolve_field
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Integer typecode with 64 bits ('q' is not available in Python 2)
+try:
+    INTEGER_TYPECODE = array('q').typecode
+except ValueError:
+    INTEGER_TYPECODE = 'l'
+
+# Internal field types stored as numeric columns
+INTEGER_TYPES = {
+    'AutoField', 'BigAutoField', 'BigIntegerField', 'IntegerField',
+    'PositiveIntegerField', 'PositiveSmallIntegerField', 'SmallIntegerField',
+}
+FLOAT_TYPES = {'FloatField'}
+
+
+def field_typecode(field):
+    """
+    Get the array typecode for the field, or None if not numeric.
+    """
+    if field is None:
+        return None
+
+    # Foreign keys have the type of the field they point to
+    if field.many_to_one or field.one_to_one:
+        field = field.foreign_related_fields[0]
+
+    internal_type = field.get_internal_type()
+    if internal_type in INTEGER_TYPES:
+        return INTEGER_TYPECODE
+    if internal_type in FLOAT_TYPES:
+        return 'd'
+    return None
+
+
+class Column(object):
+    """
+    Column values builder, stored in a compact array for numeric types
+    (falling back to a list if a value does not fit, like None).
+    """
+    def __init__(self, typecode=None):
+        self.values = array(typecode) if typecode else []
+
+    def extend(self, values):
+        if isinstance(self.values, array):
+            if None not in values:
+                length = len(self.values)
+                try:
+                    self.values.extend(values)
+                    return
+                except (TypeError, OverflowError):
+                    # Drop partially extended values, then fall back
+                    del self.values[length:]
+            self.values = self.values.tolist()
+        self.values.extend(values)
+
+    def result(self):
+        """
+        Get the final column: NumPy array if possible, array or list otherwise.
+        """
+        if numpy is not None and isinstance(self.values, array):
+            if not self.values:
+                return numpy.empty(0, dtype=self.values.typecode)
+            return numpy.frombuffer(self.values, dtype=self.values.typecode)
+        return self.values
+
+
+def column_typecodes(queryset, names):
+    """
+    Get the array typecode of every column of the values queryset, from its
+    field or annotation output field (None if not numeric or unknown).
+    """
+    query = queryset.query
+    typecodes = []
+    for name in names:
+        if name == ROLLUP_LEVEL:
+            typecodes.append(INTEGER_TYPECODE)
+            continue
+        if name in query.annotation_select:
+            try:
+                field = query.annotation_select[name].output_field
+            except FieldError:
+                field = None
+        else:
+            field = resolve_field(queryset.model, name)
+        typecodes.append(field_typecode(field))
+    return typecodes
+
+
+def fetch_columns(queryset, field_names, chunk_size=None):
+    """
+    Execute the values queryset and return an OrderedDict with a column per
+    selected name (field names as expanded, extra selects and annotations).
+    """
+    names = RowPlan.for_query(queryset.model, queryset.query, field_names).names
+    columns = [Column(typecode) for typecode in column_typecodes(queryset, names)]
+
+    # Iterate raw rows in chunks, transposing them into the columns
+    chunk_size = chunk_size or GET_ITERATOR_CHUNK_SIZE
+    rows = grouped_rows(queryset, field_names, chunk_size, True, instances=False)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        for column, values in zip(columns, zip(*chunk)):
+            column.extend(values)
+
+    return OrderedDict((name, column.result()) for name, column in zip(names, columns))
@@ -0,0 +1,95 @@
+"""
+This module contains the dimension tables mode: foreign keys are grouped
+by their column only (so the database aggregates narrow rows without
+joining), and the related instances of small tables are built from the
+whole tables' values, loaded once and kept in the process for a while (see
+dimension_cache, evicted after its ttl in seconds, or when a row of the
+table is saved or deleted in the process).
+"""
+from django.db.models.signals import post_delete, post_save
+
+from .cache import dimension_cache
+
+# Hydrate modes using dimension tables: decided by table size or forced
+DIMENSION_MODES = ('auto', 'dimensions')
+
+# Tables with at most this many rows are dimension tables in 'auto' mode
+MAX_ROWS = 1000
+
+
+def table_size(model, db):
+    """
+    Get the (cached) number of rows of the model's table.
+    """
+    key = ('size', model, db)
+    size = dimension_cache.get(key)
+    if size is None:
+        size = model._base_manager.using(db).count()
+        dimension_cache.set(key, size)
+    return size
+
+
+def is_dimension(model, mode, db):
+    """
+    Whether the model's table is a dimension table: at most MAX_ROWS rows
+    (counted when first evaluated), or any table if mode is 'dimensions'.
+    """
+    return mode == 'dimensions' or table_size(model, db) <= MAX_ROWS
+
+
+def dimension_table(model, db):
+    """
+    Get the (cached) values of the whole model's table, as the names of its
+    columns and a dict of the values of every row by pk (instances are
+    built from them for every execution, see dimension_instances).
+    """
+    key = ('table', model, db)
+    table = dimension_cache.get(key)
+    if table is None:
+        attnames = [f.attname for f in model._meta.concrete_fields]
+        queryset = model._base_manager.using(db).order_by().values_list(*attnames)
+        pk_index = attnames.index(model._meta.pk.attname)
+        table = (attnames, dict((values[pk_index], values) for values in queryset))
+        dimension_cache.set(key, table)
+    return table
+
+
+def dimension_instances(model, table, pks, db, identities):
+    """
+    Build new instances of the rows of the dimension table with the given
+    primary keys into the identities map (by model and pk).
+
+    :return: primary keys not in the table (added since it was loaded)
+    """
+    attnames, rows = table
+    missing = set()
+    for pk in pks:
+        values = rows.get(pk)
+        if values is None:
+            missing.add(pk)
+        else:
+            identities[(model, pk)] = model.from_db(db, attnames, values)
+    return missing
+
+
+def dimension_targets(plan):
+    """
+    Get the related targets of the plan grouped by primary key only, which
+    are taken from the dimension tables.
+    """
+    return [t for t in plan.related if t.pk_position == 0 and len(t.field_names) == 1]
+
+
+def evict_table(sender, using=None, **kwargs):
+    """
+    Evict the cached table and size of the sender model in the database
+    written to, used as receiver of post_save and post_delete.
+    """
+    # Nothing to do (no locking) unless tables are cached
+    if len(dimension_cache):
+        dimension_cache.delete(('table', sender, using))
+        dimension_cache.delete(('size', sender, using))
+
+
+post_save.connect(evict_table, dispatch_uid='django_group_by.dimensions')
+post_delete.connect(evict_table, dispatch_uid='django_group_by.dimensions')
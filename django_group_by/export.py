@@ -0,0 +1,91 @@
+"""
+This module contains the streaming export of group_by querysets to CSV and
+JSON Lines, written straight from the raw rows, in chunks.
+"""
+import csv
+import io
+from itertools import islice
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+from django.utils import six
+
+from .fetch import grouped_rows
+from .options import get_options
+from .plan import RowPlan
+
+
+def _encode_py2(values):
+    # Python 2 csv only writes byte strings
+    return [v.encode('utf-8') if isinstance(v, six.text_type) else v for v in values]
+
+
+def csv_chunks(names, chunks):
+    """
+    Format the chunks of rows as CSV, with a header row with the names.
+    """
+    buffer_class, encode = (io.BytesIO, _encode_py2) if six.PY2 else (io.StringIO, None)
+
+    def write(rows):
+        buf = buffer_class()
+        writer = csv.writer(buf)
+        writer.writerows(map(encode, rows) if encode else rows)
+        return buf.getvalue()
+
+    yield write([names])
+    for chunk in chunks:
+        yield write(chunk)
+
+
+def jsonl_chunks(names, chunks):
+    """
+    Format the chunks of rows as JSON Lines, an object per row with the
+    names as keys (in select order).
+    """
+    encode = DjangoJSONEncoder().encode
+    keys = ['{}: '.format(encode(name)) for name in names]
+    for chunk in chunks:
+        yield ''.join(
+            '{' + ', '.join(k + encode(v) for k, v in zip(keys, row)) + '}\n'
+            for row in chunk
+        )
+
+
+FORMATS = {
+    'csv': csv_chunks,
+    'jsonl': jsonl_chunks,
+}
+
+
+def export_rows(queryset, field_names, fmt='csv', chunk_size=None):
+    """
+    Get a generator of the formatted results of the values queryset, a
+    string per chunk of rows (plus the header, if any).
+    """
+    try:
+        formatter = FORMATS[fmt]
+    except KeyError:
+        raise ValueError('Unknown export format: {!r}'.format(fmt))
+
+    names = RowPlan.for_query(queryset.model, queryset.query, field_names).names
+    chunk_size = chunk_size or GET_ITERATOR_CHUNK_SIZE
+
+    # Lists of many to many primary keys are JSON arrays in CSV
+    m2m = get_options(queryset.query)['m2m'] or ()
+    lists = [names.index(name) for name in m2m] if fmt == 'csv' else []
+    encode = DjangoJSONEncoder().encode
+
+    def chunks():
+        rows = grouped_rows(queryset, field_names, chunk_size, True, instances=False)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            if lists:
+                chunk = [list(row) for row in chunk]
+                for row in chunk:
+                    for index in lists:
+                        row[index] = encode(row[index])
+            yield chunk
+
+    return formatter(names, chunks())
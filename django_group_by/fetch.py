@@ -0,0 +1,92 @@
+"""
+This module contains the row fetching helpers, shared by all the
+implementations, to stream results in chunks of a given size.
+"""
+import django
+from django.db.models.sql.constants import CURSOR
+
+from .options import get_options
+from .results import cached_rows
+
+
+def fetch_chunks(compiler, chunk_size, chunked_fetch=False):
+    """
+    Execute the compiled query and return an iterator of lists of at most
+    chunk_size rows, only fetched from the cursor as they are consumed.
+
+    With chunked_fetch, backends that support it (PostgreSQL) use a named
+    server-side cursor, so the client never holds more than one chunk.
+    """
+    # Server-side cursors are only available from Django 1.11
+    if chunked_fetch and django.VERSION >= (1, 11):
+        cursor = compiler.execute_sql(CURSOR, chunked_fetch=True)
+    else:
+        cursor = compiler.execute_sql(CURSOR)
+
+    # No cursor if the query is known to be empty
+    if cursor is None:
+        return iter([])
+
+    # Trim columns used only for ordering
+    col_count = getattr(compiler, 'col_count', None)
+    return _cursor_chunks(cursor, chunk_size, col_count)
+
+
+def _cursor_chunks(cursor, chunk_size, col_count):
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            if col_count is not None:
+                rows = [r[0:col_count] for r in rows]
+            yield rows
+    finally:
+        cursor.close()
+
+
+def iter_rows(compiler, chunk_size=None, chunked_fetch=False):
+    """
+    Iterate the rows of the compiled query (with converters applied), in
+    chunks of chunk_size rows if given or as Django does otherwise.
+    """
+    if not chunk_size:
+        return compiler.results_iter()
+
+    # Server-side cursors can be disabled per database
+    settings = compiler.connection.settings_dict
+    if settings.get('DISABLE_SERVER_SIDE_CURSORS'):
+        chunked_fetch = False
+
+    return compiler.results_iter(fetch_chunks(compiler, chunk_size, chunked_fetch))
+
+
+def grouped_rows(queryset, field_names, chunk_size=None, chunked_fetch=False, instances=True,
+                 stats=None):
+    """
+    Iterate the raw rows of the group_by queryset as set by its options: with
+    subtotals, from the result cache if enabled, otherwise from the database,
+    plus the lists of many to many fields (see RowPlan.for_query for their
+    columns). Shared by iteration and all the other result modes.
+
+    :param instances: many to many lists of instances, or of primary keys
+    :param stats: QueryStats to measure the rows with, before the lists
+    """
+    # Subtotals and many to many lists wrap the compiled query
+    from .m2m import m2m_rows
+    from .window import rollup_rows
+
+    query = queryset.query
+    options = get_options(query)
+    if options['rollup']:
+        rows = rollup_rows(queryset, field_names, options['rollup'])
+    elif options['cache'] is not None:
+        rows = iter(cached_rows(query.get_compiler(queryset.db), *options['cache']))
+    else:
+        rows = iter_rows(query.get_compiler(queryset.db), chunk_size, chunked_fetch)
+
+    if stats is not None:
+        rows = stats.source(rows)
+    if options['m2m']:
+        rows = m2m_rows(queryset, field_names, options['m2m'], rows, instances)
+    return rows
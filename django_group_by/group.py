@@ -1,77 +1,157 @@
-from django.utils.functional import cached_property
+import re
+
+from .cache import shape_cache
+
+
+# Attribute names that can be stored in slots (others go to a __dict__)
+SLOT_NAME = re.compile(r'^(?!__)[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _restore_group(model, attrs, values):
+    """
+    Rebuild a pickled group, creating its shape class if required.
+    """
+    return AggregatedGroup.shape(model, attrs)._make(values)
+
+
+class PendingRelated(object):
+    """
+    Raw column values of a related instance that has not been built yet,
+    with the nested instances to link to it once built.
+    """
+    __slots__ = ('target', 'values', 'db', 'identities', 'links', 'obj')
+
+    def __init__(self, target, values, db=None, identities=None):
+        self.target = target
+        self.values = values
+        self.db = db
+        self.identities = identities
+        self.links = None
+        self.obj = None
+
+    def link(self, setter, child):
+        """
+        Set the child (instance, PendingRelated or None) with the setter
+        when the instance is built.
+        """
+        if self.links is None:
+            self.links = []
+        self.links.append((setter, child))
+
+    def build(self):
+        # Built once, both the row and the parent instance may ask for it
+        if self.obj is None:
+            obj = self.obj = self.target.build_values(self.values, self.db, self.identities)
+            for setter, child in self.links or ():
+                if child.__class__ is PendingRelated:
+                    child = child.build()
+                setter(obj, child)
+        return self.obj
+
+
+class LazyRelatedAttribute(object):
+    """
+    Descriptor wrapping a slot, that builds the related instance from its
+    PendingRelated values on first access.
+    """
+    def __init__(self, slot):
+        self.slot = slot
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        value = self.slot.__get__(obj, cls)
+        if value.__class__ is PendingRelated:
+            value = value.build()
+            self.slot.__set__(obj, value)
+        return value
+
+    def __set__(self, obj, value):
+        self.slot.__set__(obj, value)
 
 
 class AggregatedGroup(object):
     """
-    Generic object that constructs related objects like a Django model
-    from queryset values() data.
+    Generic object that resembles a Django model, with the grouped values
+    and related model instances as attributes.
+
+    Rows are instances of a lightweight subclass per result shape (model
+    and attribute names), which only hold their values in __slots__.
     """
-    def __init__(self, model, row_values):
-        self._model = model
-        self._row_values = row_values
-        self._set_values()
+    __slots__ = ()
+    _model = None
+    _attrs = ()
+    _setters = ()
+
+    def __new__(cls, model, row_values):
+        """
+        Build a group from queryset values() data (a dictionary).
+        """
+        from .plan import RowPlan
+        names = tuple(row_values)
+        plan = RowPlan.get(model, names)
+        return plan.decode(tuple(row_values[k] for k in names))
 
     def __repr__(self):
-        return u'<{} for {}>'.format(self.__class__.__name__,
+        return u'<{} for {}>'.format(AggregatedGroup.__name__,
                                      self._model.__name__)
 
-    @cached_property
-    def _data(self):
+    def __reduce__(self):
+        # Lazy related values get built, so the shape is never lazy
+        values = tuple(getattr(self, a) for a in self._attrs)
+        return _restore_group, (self._model, self._attrs, values)
+
+    @classmethod
+    def shape(cls, model, attrs, lazy=()):
         """
-        Cached data built from instance raw _values as a dictionary.
+        Get the (cached) subclass for the model and attribute names, where
+        lazy attributes are built from PendingRelated values on access.
         """
-        d = {}
+        attrs = tuple(attrs)
+        lazy = tuple(lazy)
+        key = (model, attrs, lazy)
+        shape = shape_cache.get(key)
+        if shape is None:
+            shape = cls._create_shape(model, attrs, lazy)
+            shape_cache.set(key, shape)
+        return shape
 
-        # Iterate all keys and values
-        for k, v in self._row_values.items():
-            # Split related model fields
-            attrs = k.rsplit('__', 1)
-
-            # Set value depending case
-            if len(attrs) == 2:
-                # Related model field, store nested
-                fk, fn = attrs
-                if fk not in d:
-                    d[fk] = {}
-                d[fk][fn] = v
+    @classmethod
+    def _create_shape(cls, model, attrs, lazy=()):
+        """
+        Create the subclass for the given model and attribute names.
+        """
+        # Names that can't be slots are kept in a __dict__ instead
+        reserved = set(dir(AggregatedGroup))
+        slots = [str(a) for a in attrs
+                 if SLOT_NAME.match(a) and a not in reserved]
+        if len(slots) < len(attrs):
+            slots.append('__dict__')
 
-            else:
-                # Own model field, store directly
-                d[k] = v
+        # Create class, then get a setter per attribute
+        name = 'AggregatedGroup_{}'.format(model.__name__ if model else '')
+        shape = type(name, (cls,), {
+            '__slots__': tuple(slots), '__module__': cls.__module__,
+            '_model': model, '_attrs': attrs,
+        })
+        shape._setters = tuple(
+            getattr(shape, a).__set__ if a in slots else
+            (lambda obj, value, a=a: obj.__dict__.__setitem__(a, value))
+            for a in attrs
+        )
 
-        # Return (+cache) data
-        return d
+        # Wrap lazy attribute slots (setters keep the raw slot)
+        for a in lazy:
+            if a in slots:
+                setattr(shape, a, LazyRelatedAttribute(getattr(shape, a)))
+        return shape
 
-    def _set_values(self):
+    @classmethod
+    def _make(cls, values):
         """
-        Populate instance with given.
+        Create an instance of this shape with the values, in attribute order.
         """
-        # Iterate all keys and values in data
-        for k, v in self._data.items():
-            # If it's a dict, process it (it's probably instance data)
-            if isinstance(v, dict):
-                try:
-                    # Get related model from field (follow path)
-                    rel_model = self._model
-                    for attr in k.split('__'):
-                        rel_model = getattr(rel_model, attr).field.related_model
-
-                except AttributeError:
-                    # Not a model, maybe it is a dict field (?)
-                    pass
-
-                else:
-                    # Model, first shorten field name
-                    k = k.replace('__', '_')
-
-                    # Now init instance if required (not if we got ID None)
-                    if 'id' in v and v['id'] is None:
-                        # This means we grouped by ID, if it's none then FK is None
-                        v = None
-
-                    else:
-                        # Either we have ID or we didn't group by ID, use instance
-                        v = rel_model(**v)
-
-            # Set value
-            setattr(self, k, v)
+        obj = object.__new__(cls)
+        for setter, value in zip(cls._setters, values):
+            setter(obj, value)
+        return obj
@@ -0,0 +1,98 @@
+"""
+This module contains the batched hydration of related instances: rows are
+grouped by foreign key only, and the related objects are fetched afterwards
+with one query per related model (in_bulk style) instead of being joined,
+or built from cached dimension tables (see dimensions.py).
+"""
+from itertools import islice
+
+from django.db import connections
+
+from .dimensions import (DIMENSION_MODES, dimension_instances, dimension_table,
+                         dimension_targets, is_dimension)
+
+
+def fetch_related(model, pks, db, identities):
+    """
+    Fetch the model instances with the given primary keys into the
+    identities map (by model and pk), in batches the database can take.
+    """
+    pks = list(pks)
+    ops = connections[db].ops
+    batch_size = ops.bulk_batch_size(['pk'], pks) or len(pks)
+    queryset = model._base_manager.using(db).order_by()
+    for start in range(0, len(pks), batch_size):
+        for obj in queryset.filter(pk__in=pks[start:start + batch_size]):
+            identities[(model, obj.pk)] = obj
+
+
+def hydrate_rows(plan, rows, db, identities, chunk_size=None, targets=None, tables=None):
+    """
+    Iterate the raw rows, first fetching the related instances of all of them
+    (or of every chunk of chunk_size rows) into the identities map, where the
+    row decoder will find them.
+
+    :param targets: related targets to fetch, all grouped by pk if not given
+    :param tables: dimension tables to build instances from, by model
+    """
+    # Related targets by model (grouped by pk, otherwise nothing to fetch)
+    if targets is None:
+        targets = [t for t in plan.related if t.pk_position is not None]
+    if not targets:
+        for row in rows:
+            yield row
+        return
+
+    rows = iter(rows)
+    while True:
+        # Whole results at once, unless streaming
+        chunk = list(islice(rows, chunk_size) if chunk_size else rows)
+        if not chunk:
+            break
+
+        # Collect the missing primary keys of each model
+        missing = {}
+        for target in targets:
+            pks = missing.setdefault(target.model, set())
+            getter, position = target.getter, target.pk_position
+            for row in chunk:
+                pk = getter(row)[position]
+                if pk is not None and (target.model, pk) not in identities:
+                    pks.add(pk)
+
+        # Then build them from the tables, or fetch them with one query per model
+        for model, pks in missing.items():
+            if tables and model in tables:
+                pks = dimension_instances(model, tables[model], pks, db, identities)
+            if pks:
+                fetch_related(model, pks, db, identities)
+
+        for row in chunk:
+            yield row
+
+
+def apply_hydrate(plan, rows, db, options, chunk_size=None):
+    """
+    Apply the hydrate option to the raw rows: related instances fetched in
+    batches, or built from the dimension tables (rows added since they were
+    loaded are fetched), into the identities map of the decoder.
+
+    :return: rows and options for the row factory
+    """
+    from .rows import dict_rows, namedtuple_rows, tuple_rows
+
+    mode = options['hydrate']
+    if mode is None or options['row_factory'] in (tuple_rows, dict_rows, namedtuple_rows):
+        # Nothing to hydrate, or plain rows without related instances
+        return rows, options
+
+    identities = {}
+    targets = tables = None
+    if mode in DIMENSION_MODES:
+        # Decided when evaluated, bigger tables are fetched in batches
+        targets = dimension_targets(plan)
+        tables = dict((model, dimension_table(model, db))
+                      for model in set(t.model for t in targets)
+                      if is_dimension(model, mode, db))
+    rows = hydrate_rows(plan, rows, db, identities, chunk_size, targets, tables)
+    return rows, dict(options, identity_map=identities)
@@ -0,0 +1,169 @@
+"""
+This module contains the optional instrumentation of group_by querysets: a
+signal sent once per evaluated query with its timings and counts, and
+adapters that log them or collect them in a local metrics registry.
+
+Nothing is measured unless the signal has receivers.
+"""
+import logging
+from threading import Lock
+from timeit import default_timer
+
+from django.dispatch import Signal
+
+
+# Sent with the QueryStats of every evaluated group_by query, by model
+query_executed = Signal(providing_args=['stats'])
+
+
+def instrumented(model):
+    """
+    Whether queries of the model have to be measured (there are receivers).
+    """
+    return query_executed.has_listeners(model)
+
+
+class QueryStats(object):
+    """
+    Timings (in seconds) and counts of one evaluation of a group_by query:
+
+        fields: number of expanded group_by fields
+        sql_time: time until the first raw row (query execution)
+        fetch_time: time fetching the rest of the raw rows
+        related_time: time fetching related instances (hydrate) and many
+            to many lists, the follow-up queries around the raw rows
+        decode_time: time building the rows (and related instances)
+        rows: number of rows yielded
+        related: number of related instances in the rows (not None)
+    """
+    __slots__ = ('model', 'db', 'fields', 'sql_time', 'fetch_time',
+                 'related_time', 'decode_time', 'rows', 'related')
+
+    def __init__(self, model, db, fields):
+        self.model = model
+        self.db = db
+        self.fields = fields
+        self.sql_time = self.fetch_time = self.related_time = self.decode_time = 0.0
+        self.rows = self.related = 0
+
+    def __repr__(self):
+        return u'<QueryStats for {}: {}>'.format(self.model.__name__, self.as_dict())
+
+    def as_dict(self):
+        return dict((k, getattr(self, k)) for k in
+                    ('fields', 'sql_time', 'fetch_time', 'related_time', 'decode_time',
+                     'rows', 'related'))
+
+    def source(self, rows):
+        """
+        Iterate the raw rows of the query measuring the time executing it
+        (until the first row) and fetching the rest, before any wrapper
+        (hydration, many to many lists) is applied to them.
+        """
+        timer = default_timer
+        rows = iter(rows)
+        fetched = False
+        while True:
+            fetching = timer()
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            finally:
+                # Time until the first row includes executing the query
+                if fetched:
+                    self.fetch_time += timer() - fetching
+                else:
+                    self.sql_time += timer() - fetching
+            fetched = True
+            yield row
+
+    def iterate(self, plan, rows, decode):
+        """
+        Iterate the decoded rows (of raw rows given by source(), possibly
+        wrapped) measuring every step, then send the signal (also if the
+        iteration is not completed).
+        """
+        timer = default_timer
+        targets = [(t.getter, t.pk_position) for t in plan.related]
+        rows = iter(rows)
+        try:
+            while True:
+                # Waiting for a row includes the source's time, measured apart
+                waiting = timer()
+                measured = self.sql_time + self.fetch_time
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    break
+                finally:
+                    self.related_time += (timer() - waiting -
+                                          (self.sql_time + self.fetch_time - measured))
+
+                decoding = timer()
+                obj = decode(row)
+                self.decode_time += timer() - decoding
+                self.rows += 1
+                for getter, position in targets:
+                    if position is None or getter(row)[position] is not None:
+                        self.related += 1
+                yield obj
+        finally:
+            query_executed.send(sender=self.model, stats=self)
+
+
+class LoggingAdapter(object):
+    """
+    Receiver that logs the stats of every query, connect with:
+
+        query_executed.connect(LoggingAdapter(), weak=False)
+    """
+    def __init__(self, logger='django_group_by', level=logging.DEBUG):
+        if not isinstance(logger, logging.Logger):
+            logger = logging.getLogger(logger)
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, sender, stats, **kwargs):
+        self.logger.log(
+            self.level,
+            'group_by %s (%s): %d fields, %d rows, %d related, '
+            'sql %.6fs, fetch %.6fs, related %.6fs, decode %.6fs',
+            sender.__name__, stats.db, stats.fields, stats.rows, stats.related,
+            stats.sql_time, stats.fetch_time, stats.related_time, stats.decode_time)
+
+
+class MetricsRegistry(object):
+    """
+    Receiver that accumulates the stats by model, in a local registry that
+    exporters can read with snapshot(). Connect with:
+
+        query_executed.connect(MetricsRegistry(), weak=False)
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def __call__(self, sender, stats, **kwargs):
+        key = '{}.{}'.format(sender._meta.app_label, sender._meta.model_name)
+        with self._lock:
+            metrics = self._metrics.get(key)
+            if metrics is None:
+                metrics = self._metrics[key] = dict.fromkeys(
+                    ('queries', 'fields', 'rows', 'related'), 0)
+                metrics.update(dict.fromkeys(
+                    ('sql_time', 'fetch_time', 'related_time', 'decode_time'), 0.0))
+            metrics['queries'] += 1
+            for name, value in stats.as_dict().items():
+                metrics[name] += value
+
+    def snapshot(self):
+        """
+        Get a copy of the totals, by 'app_label.model_name'.
+        """
+        with self._lock:
+            return dict((k, dict(v)) for k, v in self._metrics.items())
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
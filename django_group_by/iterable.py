@@ -3,8 +3,14 @@ This module contains the implementations for Django 1.9 and above, for which we
 need a customized ValuesIterable.
 """
 from django.db.models.query import ValuesIterable
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
 
-from .group import AggregatedGroup
+from .fetch import grouped_rows
+from .instrument import QueryStats, instrumented
+from .m2m import split_m2m_fields
+from .options import get_options, set_options
+from .plan import RowPlan
+from .rows import iter_decoded
 
 
 class GroupByIterable(ValuesIterable):
@@ -17,16 +23,26 @@ class GroupByIterable(ValuesIterable):
         # Same as in django
         queryset = self.queryset
         query = queryset.query
-        compiler = query.get_compiler(queryset.db)
-        field_names = list(query.values_select)
-        extra_names = list(query.extra_select)
-        annotation_names = list(query.annotation_select)
-        names = extra_names + field_names + annotation_names
-
-        # Iterate results and yield AggregatedGroup instances
-        for row in compiler.results_iter():
-            data = dict(zip(names, row))
-            obj = AggregatedGroup(queryset.model, data)
+
+        # Get the (cached) row plan and options once
+        plan = RowPlan.for_query(queryset.model, query, query.values_select)
+        options = get_options(query)
+
+        # Fetch in chunks if set as option, or by iterator() on Django 1.11+
+        chunk_size = options['chunk_size']
+        chunked_fetch = bool(chunk_size) or getattr(self, 'chunked_fetch', False)
+        if chunked_fetch and not chunk_size:
+            chunk_size = getattr(self, 'chunk_size', GET_ITERATOR_CHUNK_SIZE)
+
+        # Measure only if there are receivers for the stats
+        stats = None
+        if instrumented(queryset.model):
+            stats = QueryStats(queryset.model, queryset.db, len(query.values_select))
+
+        # Raw rows as set by the options, then decoded by the row factory
+        rows = grouped_rows(queryset, query.values_select, chunk_size, chunked_fetch,
+                            stats=stats)
+        for obj in iter_decoded(plan, rows, queryset.db, options, chunk_size, stats):
             yield obj
 
 
@@ -34,14 +50,47 @@ class GroupByIterableMixinBase(object):
     """
     Implementation of the group_by method using GroupByIterable.
     """
-    def group_by(self, *fields):
+    def group_by(self, *fields, **options):
         """
         Clone the queryset using GroupByQuerySet.
 
         :param fields:
+        :param options:
+            only: related fields to select, grouping FKs by primary key
+            hydrate: 'batch' to group FKs by primary key and fetch related
+                instances afterwards, one query per model; 'dimensions' to
+                take them from whole cached tables instead, or 'auto' to do
+                so only for FKs to small tables (see dimensions.py)
+            lazy_related: build related instances on first access
+            identity_map: share related instances with the same pk
+            chunk_size: fetch rows in chunks when iterating
+            row_factory: function returning the row builder, see rows.py
+            rollup: add subtotal rows for every prefix of the fields
+            m2m: 'batch' to fetch many to many fields apart, as lists of
+                related instances, instead of grouping by them
         :return:
         """
-        fields = self._expand_group_by_fields(self.model, fields)
+        only = options.pop('only', None)
+        if only is None and options.get('hydrate') is not None:
+            # FKs by primary key, related instances fetched (or taken) apart
+            only = ()
+        if options.get('m2m') is not None:
+            # Many to many fields are not grouped by, but fetched apart
+            fields, options['m2m'] = split_m2m_fields(self.model, fields, options['m2m'])
+        if options.get('rollup'):
+            # Columns of every field, the levels of the subtotals
+            options['rollup'] = tuple(self._get_group_by_fields(self.model, [f], only)
+                                      for f in fields)
+        fields = self._get_group_by_fields(self.model, fields, only)
         clone = self._values(*fields)
         clone._iterable_class = GroupByIterable
+        set_options(clone.query, options)
         return clone
+
+    def _group_by_field_names(self):
+        """
+        Get the values field names of a group_by queryset.
+        """
+        if self._iterable_class is not GroupByIterable:
+            raise TypeError('Only available after calling group_by().')
+        return list(self.query.values_select)
@@ -0,0 +1,207 @@
+"""
+This module contains the keyset (seek) pagination of group_by querysets:
+pages are ordered by the group key columns and start right after the key
+of the previous page's last row, so deep pages cost the same as the first.
+"""
+import base64
+import hashlib
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+
+from django.db import connections
+from django.db.models import Q
+
+from .options import get_options, set_options
+from .plan import RowPlan, resolve_field, resolve_model
+from .rows import decode_rows, tuple_rows
+
+
+class CursorEncoder(json.JSONEncoder):
+    """
+    JSON encoder for the key values of cursors, which keeps full precision
+    of dates and decimals (decoded with the fields' to_python).
+    """
+    def default(self, o):
+        if isinstance(o, (datetime, date, time)):
+            return o.isoformat()
+        if isinstance(o, Decimal):
+            return str(o)
+        return super(CursorEncoder, self).default(o)
+
+
+def key_columns(model, field_names):
+    """
+    Get the columns that identify the groups: the grouped fields, but only
+    the primary key of related instances if grouped by it (all their other
+    columns depend on it).
+    """
+    # Related paths grouped by primary key, with its column
+    pks = {}
+    for name in field_names:
+        if '__' in name:
+            path, attr = name.rsplit('__', 1)
+            related = resolve_model(model, path)
+            if related is not None and attr in (related._meta.pk.attname,
+                                                related._meta.pk.column):
+                pks[path] = name
+
+    keys = []
+    for name in field_names:
+        parts = name.split('__')
+        for i in range(1, len(parts)):
+            path = '__'.join(parts[:i])
+            if path in pks:
+                if pks[path] == name:
+                    keys.append(name)
+                break
+        else:
+            keys.append(name)
+    return keys
+
+
+def _multi_valued(model, name):
+    # Whether the lookup path follows a many to many or reverse FK relation
+    for attr in name.split('__')[:-1]:
+        field = model._meta.get_field(attr)
+        if field.many_to_many or field.one_to_many:
+            return True
+        model = field.related_model
+    return False
+
+
+def encode_cursor(keys, values):
+    """
+    Get the opaque cursor for the key values of a row.
+    """
+    data = json.dumps([_keys_digest(keys), list(values)], cls=CursorEncoder)
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, model, keys):
+    """
+    Get the key values of an opaque cursor, for the same key columns.
+    """
+    try:
+        digest, values = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor: {!r}'.format(cursor))
+    if digest != _keys_digest(keys) or len(values) != len(keys):
+        raise ValueError('The cursor is from a query with other group keys.')
+    return [value if value is None else resolve_field(model, key).to_python(value)
+            for key, value in zip(keys, values)]
+
+
+def _keys_digest(keys):
+    return hashlib.md5(','.join(keys).encode('utf-8')).hexdigest()[:8]
+
+
+def seek_filter(keys, values, nulls_largest=False):
+    """
+    Get the filter of the rows after the key values, in ascending order of
+    the keys: the first key greater, or equal and the next one greater, etc.
+    NULL sorts first, unless nulls_largest (as the database does).
+    """
+    after = Q(pk__in=[])
+    equal = Q()
+    for key, value in zip(keys, values):
+        if value is None:
+            greater = Q(pk__in=[]) if nulls_largest else Q(**{key + '__isnull': False})
+            same = Q(**{key + '__isnull': True})
+        else:
+            greater = Q(**{key + '__gt': value})
+            if nulls_largest:
+                greater |= Q(**{key + '__isnull': True})
+            same = Q(**{key: value})
+        after |= equal & greater
+        equal &= same
+    return after
+
+
+class KeysetPage(object):
+    """
+    Page of a group_by queryset: its rows, the cursor of the next page
+    (None if this is the last one) and the count of all the rows if asked.
+    """
+    def __init__(self, rows, next_cursor, count=None):
+        self.rows = rows
+        self.next_cursor = next_cursor
+        self.count = count
+
+    def __repr__(self):
+        return u'<KeysetPage: {} rows>'.format(len(self.rows))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, index):
+        return self.rows[index]
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def estimate_count(queryset):
+    """
+    Get the number of rows of the queryset as estimated by the database
+    planner (PostgreSQL), or the exact count on other databases.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    return queryset.count()
+
+
+def page_rows(queryset, field_names, cursor=None, size=20, count=None):
+    """
+    Get the page of the group_by queryset after the cursor (or the first
+    page), ordered by its group keys.
+
+    :param count: None, 'exact' or 'estimate' (by the planner)
+    """
+    options = get_options(queryset.query)
+    if options['rollup']:
+        raise ValueError("Can't paginate queries with subtotals.")
+    if size < 1:
+        raise ValueError('The page size must be positive.')
+    if count not in (None, 'exact', 'estimate'):
+        raise ValueError('Unknown count mode: {!r}'.format(count))
+    model = queryset.model
+    keys = key_columns(model, field_names)
+    if any(_multi_valued(model, key) for key in keys):
+        # Seek filters would join them again
+        raise ValueError("Can't paginate by many to many fields, use m2m='batch'.")
+
+    # Total before seeking, of all the pages
+    total = None
+    if count == 'exact':
+        total = queryset.order_by().count()
+    elif count == 'estimate':
+        total = estimate_count(queryset.order_by())
+
+    # Raw rows after the cursor, one more to know if there are more pages
+    page = queryset.order_by(*keys)
+    if cursor is not None:
+        nulls_largest = connections[queryset.db].features.nulls_order_largest
+        page = page.filter(seek_filter(keys, decode_cursor(cursor, model, keys), nulls_largest))
+    set_options(page.query, {'row_factory': tuple_rows, 'hydrate': None})
+    rows = list(page[:size + 1])
+
+    # Cursor from the last row's keys
+    plan = RowPlan.for_query(model, queryset.query, field_names)
+    next_cursor = None
+    if len(rows) > size:
+        rows = rows[:size]
+        indexes = [plan.names.index(key) for key in keys]
+        next_cursor = encode_cursor(keys, [rows[-1][i] for i in indexes])
+    return KeysetPage(decode_rows(plan, rows, queryset.db, options), next_cursor, total)
@@ -0,0 +1,115 @@
+"""
+This module contains the many to many mode of group_by: M2M fields are left
+out of the grouped query (so its rows are not multiplied by the join), and
+their related instances are fetched with one follow-up query per field, as
+a list in every row.
+"""
+from django.db.models import ManyToManyField, Q
+
+from .keyset import key_columns
+from .plan import RelatedTarget, query_names
+from .window import _level_query
+
+
+def split_m2m_fields(model, fields, mode):
+    """
+    Split the group_by fields into the ones to group by and the many to
+    many ones, to fetch apart.
+
+    :param mode: 'batch' (a follow-up query per many to many field)
+    :return: fields to group by, many to many field names
+    """
+    if mode != 'batch':
+        raise ValueError("Unknown m2m mode: {!r}".format(mode))
+    fields, m2m = list(fields), []
+    for name in list(fields):
+        if '__' not in name and isinstance(model._meta.get_field(name), ManyToManyField):
+            fields.remove(name)
+            m2m.append(name)
+    if m2m and not fields:
+        raise ValueError("Can't group only by many to many fields with m2m='batch'.")
+    return fields, tuple(m2m)
+
+
+def groups_filter(model, field_names, names, rows):
+    """
+    Get the filter of the groups of the raw rows, by their key columns.
+    """
+    columns = key_columns(model, field_names)
+    indexes = [names.index(column) for column in columns]
+    lookup = Q(pk__in=[])
+    for row in rows:
+        group = Q()
+        for column, index in zip(columns, indexes):
+            value = row[index]
+            group &= Q(**{column + '__isnull': True} if value is None else {column: value})
+        lookup |= group
+    return lookup
+
+
+def fetch_m2m_lists(query, model, field_names, name, db, groups=None, instances=True):
+    """
+    Fetch the related instances of the many to many field for every group
+    of the values query, by the values of the fields (without aggregates).
+
+    :param groups: filter of the groups to fetch, all if not given
+    :param instances: lists of instances, or of their primary keys
+    :return: dict of lists of related instances, by group key
+    """
+    from .mixin import GroupByMixin
+
+    # Groups by their key and the related instance's columns
+    columns = GroupByMixin._get_group_by_fields(model, [name])
+    follow = _level_query(query, list(field_names) + list(columns))
+    follow.set_annotation_mask(())
+    follow.set_extra_mask(())
+    follow.add_ordering(columns[0])
+    if groups is not None:
+        follow.add_q(groups)
+
+    # Instances are shared by all the lists (same pk, same instance)
+    size = len(field_names)
+    target = RelatedTarget(name, model._meta.get_field(name).related_model,
+                           [c.split('__', 1)[1] for c in columns],
+                           range(size, size + len(columns)))
+    pk_index = size + target.pk_position
+    identities = {}
+    lists = {}
+    for row in follow.get_compiler(db).results_iter():
+        related = lists.setdefault(tuple(row[:size]), [])
+        if not instances:
+            if row[pk_index] is not None:
+                related.append(row[pk_index])
+            continue
+        obj = target.build(row, db, identities)
+        if obj is not None:
+            related.append(obj)
+    return lists
+
+
+def m2m_rows(queryset, field_names, m2m, rows, instances=True):
+    """
+    Iterate the raw rows with a list of related instances (or of their
+    primary keys) appended for every many to many field (fetched before
+    the first row).
+    """
+    query = queryset.query
+
+    # Filters on aggregates (HAVING, apart on Django 1.8) need whole groups
+    if query.where.contains_aggregate or getattr(query, 'having', None):
+        raise ValueError("Can't fetch many to many lists of queries filtered by aggregates.")
+    names, _ = query_names(query, field_names)
+    keys = [names.index(name) for name in field_names]
+
+    # Sliced (e.g. a page), only the lists of its groups
+    groups = None
+    if query.low_mark or query.high_mark is not None:
+        rows = list(rows)
+        groups = groups_filter(queryset.model, field_names, names, rows)
+    lists = [fetch_m2m_lists(query, queryset.model, field_names, name, queryset.db, groups,
+                             instances)
+             for name in m2m]
+
+    for row in rows:
+        key = tuple(row[i] for i in keys)
+        yield tuple(row) + tuple(list(related.get(key, ())) for related in lists)
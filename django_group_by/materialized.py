@@ -0,0 +1,379 @@
+"""
+This module contains the materialized aggregates: grouped Count and Sum
+aggregations declared once, and kept in a summary table that is updated
+incrementally when rows are saved or deleted, or caught up periodically
+by a timestamp field. Reading them never touches the base table.
+
+Groups are stored by their own columns and the primary keys of related
+instances, whose other columns are read when loading them (so changes to
+related rows are always seen).
+
+Requires django_group_by in INSTALLED_APPS (for the summary tables).
+"""
+import hashlib
+import json
+from collections import OrderedDict
+from datetime import date, datetime, time
+from decimal import Decimal
+
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import Count, ForeignKey, Max, Q, Sum
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+
+from .hydrate import fetch_related
+from .models import GroupSummary, SummaryCheckpoint
+from .plan import RowPlan, resolve_field, resolve_model
+
+# Registered aggregates, by name
+registry = {}
+
+# Hidden annotation with the number of rows of each group
+ROWS = '_group_rows'
+
+# Instance attribute with the contributions of its old values, by name
+OLD_ROWS = '_group_by_old_rows'
+
+
+class SummaryEncoder(json.JSONEncoder):
+    """
+    JSON encoder for the summary values, which keeps full precision of dates
+    and decimals (decoded with the fields' to_python).
+    """
+    def default(self, o):
+        if isinstance(o, (datetime, date, time)):
+            return o.isoformat()
+        if isinstance(o, Decimal):
+            return str(o)
+        return super(SummaryEncoder, self).default(o)
+
+
+def _add(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+
+def _negate(value):
+    return None if value is None else -value
+
+
+def _key_fields(model, fields):
+    """
+    Get the stored key columns of the group_by fields (own columns and
+    related primary keys), and the relation path of every related key.
+    """
+    from .mixin import GroupByMixin
+
+    keys = []
+    paths = {}
+    for name in fields:
+        path = name
+        if not isinstance(resolve_field(model, name), ForeignKey):
+            # Related column (by the pk of its instance) or own column
+            path = name.rsplit('__', 1)[0] if '__' in name else None
+        if path is None:
+            columns = [name]
+        else:
+            columns = GroupByMixin._get_group_by_fields(model, [path], ())
+            paths[columns[0]] = path
+        keys.extend(c for c in columns if c not in keys)
+    return keys, paths
+
+
+def _column_value(obj, column):
+    # Value of the column (as expanded, by field name or column) of the instance
+    if obj is None:
+        return None
+    for field in obj._meta.concrete_fields:
+        if column in (field.name, field.column):
+            return getattr(obj, field.attname)
+    return getattr(obj, column)
+
+
+class MaterializedAggregate(object):
+    """
+    Grouped aggregation of a queryset (values of the expanded fields plus
+    Count and Sum annotations), stored by group in GroupSummary rows.
+    """
+    def __init__(self, name, queryset, fields, annotations, timestamp=None):
+        from .mixin import GroupByMixin
+
+        self.name = name
+        self.queryset = queryset
+        self.model = queryset.model
+        self.fields = list(GroupByMixin._get_group_by_fields(self.model, fields))
+        self.keys, self.paths = _key_fields(self.model, fields)
+        self.annotations = OrderedDict(sorted(annotations.items()))
+        self.timestamp = timestamp
+        self.names = self.keys + list(self.annotations)
+
+        # Only aggregates that can be updated with deltas
+        for alias, annotation in self.annotations.items():
+            distinct = getattr(annotation, 'distinct', None) or annotation.extra.get('distinct')
+            if type(annotation) not in (Count, Sum) or distinct:
+                raise ValueError("Can't materialize {!r} ({}), only Count and Sum are "
+                                 "supported.".format(alias, annotation))
+
+        # Converters of the stored values, by key field or output field
+        query = self.grouped().query
+        self.converters = []
+        for name in self.names:
+            if name in self.annotations:
+                field = query.annotation_select[name].output_field
+            else:
+                field = resolve_field(self.model, name)
+            self.converters.append(field.to_python if field is not None else None)
+        self.converters.append(None)
+
+    def grouped(self, using=None):
+        """
+        Get the grouped values queryset (dicts) with the aggregates and the
+        number of rows.
+        """
+        queryset = self.queryset if using is None else self.queryset.using(using)
+        annotations = dict(self.annotations)
+        annotations[ROWS] = Count('pk')
+        return queryset.order_by().values(*self.keys).annotate(**annotations)
+
+    def _key(self, row):
+        data = json.dumps([row[f] for f in self.keys], cls=SummaryEncoder)
+        return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+    def _dump(self, row):
+        return json.dumps([row[n] for n in self.names] + [row[ROWS]], cls=SummaryEncoder)
+
+    def _load(self, data):
+        return [value if convert is None or value is None else convert(value)
+                for convert, value in zip(self.converters, json.loads(data))]
+
+    def _db(self, using=None):
+        return using or router.db_for_write(GroupSummary)
+
+    def rows(self, using=None):
+        """
+        Get the current groups as AggregatedGroup rows, like group_by(), with
+        the current related columns (one query per related model).
+        """
+        db = self._db(using)
+        summaries = GroupSummary.objects.using(db).filter(name=self.name)
+        stored = [dict(zip(self.names, self._load(data)))
+                  for data in summaries.values_list('values', flat=True)]
+
+        # Related instances of the stored keys
+        read_db = router.db_for_read(self.model)
+        identities = {}
+        models = {}
+        for key, path in self.paths.items():
+            models[key] = resolve_model(self.model, path)
+            fetch_related(models[key], set(row[key] for row in stored if row[key] is not None),
+                          read_db, identities)
+
+        # Columns of the groups from them, then groups with the same columns
+        # (e.g. related instances renamed alike) added up
+        paths = sorted(self.paths.items(), key=lambda item: -len(item[1]))
+        groups = OrderedDict()
+        for row in stored:
+            instances = dict((path, identities.get((models[key], row[key])))
+                             for key, path in paths)
+            values = []
+            for name in self.fields:
+                if name in row:
+                    values.append(row[name])
+                    continue
+                path = next(p for _, p in paths if name.startswith(p + '__'))
+                values.append(_column_value(instances[path], name[len(path) + 2:]))
+            values = tuple(values)
+            group = groups.get(values)
+            if group is None:
+                groups[values] = dict((a, row[a]) for a in self.annotations)
+            else:
+                for name in self.annotations:
+                    group[name] = _add(group[name], row[name])
+
+        plan = RowPlan.get(self.model, self.fields + list(self.annotations), list(self.annotations))
+        decode = plan.decoder(read_db)
+        return [decode(values + tuple(group[a] for a in self.annotations))
+                for values, group in groups.items()]
+
+    def apply(self, rows, sign=1, using=None):
+        """
+        Add (or subtract, with sign -1) the rows' aggregates to their groups.
+        """
+        db = self._db(using)
+        for row in rows:
+            key = self._key(row)
+            try:
+                with transaction.atomic(using=db):
+                    self._apply_row(db, key, row, sign)
+            except IntegrityError:
+                # New group created meanwhile by another writer (nothing was
+                # locked), now it's there to add to
+                with transaction.atomic(using=db):
+                    self._apply_row(db, key, row, sign)
+
+    def _apply_row(self, db, key, row, sign):
+        summaries = GroupSummary.objects.using(db)
+        summary = summaries.select_for_update().filter(name=self.name, key=key).first()
+        if summary is None:
+            # New group, nothing to subtract from
+            if sign > 0:
+                summaries.create(name=self.name, key=key, values=self._dump(row))
+            return
+
+        # Add every aggregate and the rows to the group's values
+        values = dict(zip(self.names + [ROWS], self._load(summary.values)))
+        for name in list(self.annotations) + [ROWS]:
+            delta = row[name] if sign > 0 else _negate(row[name])
+            values[name] = _add(values[name], delta)
+        if values[ROWS] > 0:
+            summary.values = self._dump(values)
+            summary.save(update_fields=['values'])
+        else:
+            summary.delete()
+
+    def rebuild(self, using=None):
+        """
+        Recompute all the groups from the base table.
+        """
+        db = self._db(using)
+        summaries = [GroupSummary(name=self.name, key=self._key(row), values=self._dump(row))
+                     for row in self.grouped(db)]
+        with transaction.atomic(using=db):
+            GroupSummary.objects.using(db).filter(name=self.name).delete()
+            GroupSummary.objects.using(db).bulk_create(summaries)
+            if self.timestamp:
+                high = self.queryset.using(db).aggregate(high=Max(self.timestamp))['high']
+                self._set_checkpoint(db, high)
+
+    def catch_up(self, using=None):
+        """
+        Recompute the groups of the rows changed since the last catch up (by
+        the timestamp field), or all of them the first time. Rows that are
+        deleted or moved between groups are only noticed by the signals.
+
+        :return: number of groups recomputed
+        """
+        db = self._db(using)
+        checkpoint = SummaryCheckpoint.objects.using(db).filter(name=self.name).first()
+        if checkpoint is None:
+            self.rebuild(db)
+            return GroupSummary.objects.using(db).filter(name=self.name).count()
+
+        # Keys of the groups with changes up to now
+        last = json.loads(checkpoint.timestamp)
+        changed = self.queryset.using(db)
+        if last is not None:
+            field = resolve_field(self.model, self.timestamp)
+            changed = changed.filter(**{self.timestamp + '__gt': field.to_python(last)})
+        high = changed.aggregate(high=Max(self.timestamp))['high']
+        if high is None:
+            return 0
+        changed = changed.filter(**{self.timestamp + '__lte': high}).order_by()
+        keys = list(changed.values_list(*self.keys).distinct())
+
+        # Recompute them in batches (by their key values)
+        batch_size = connections[db].ops.bulk_batch_size(self.keys, keys) or len(keys)
+        for start in range(0, len(keys), batch_size):
+            lookup = Q()
+            for key in keys[start:start + batch_size]:
+                lookup |= Q(**dict(zip(self.keys, key)))
+            self.refresh(self.grouped(db).filter(lookup), db)
+
+        self._set_checkpoint(db, high)
+        return len(keys)
+
+    def refresh(self, rows, using=None):
+        """
+        Replace the values of the groups of the rows.
+        """
+        db = self._db(using)
+        summaries = GroupSummary.objects.using(db)
+        for row in rows:
+            key = self._key(row)
+            with transaction.atomic(using=db):
+                updated = summaries.filter(name=self.name, key=key).update(values=self._dump(row))
+                if not updated:
+                    summaries.create(name=self.name, key=key, values=self._dump(row))
+
+    def _set_checkpoint(self, db, timestamp):
+        data = json.dumps(timestamp, cls=SummaryEncoder)
+        updated = SummaryCheckpoint.objects.using(db).filter(name=self.name).update(timestamp=data)
+        if not updated:
+            SummaryCheckpoint.objects.using(db).create(name=self.name, timestamp=data)
+
+    # Signal receivers, with the contributions of the saved or deleted row
+
+    def _store_old(self, sender, instance, using, **kwargs):
+        if instance.pk is None or kwargs.get('raw'):
+            return
+        old = list(self.grouped(using).filter(pk=instance.pk))
+        instance.__dict__.setdefault(OLD_ROWS, {})[self.name] = old
+
+    def _saved(self, sender, instance, using, **kwargs):
+        if kwargs.get('raw'):
+            return
+        old = instance.__dict__.get(OLD_ROWS, {}).pop(self.name, ())
+        new = list(self.grouped(using).filter(pk=instance.pk))
+        with transaction.atomic(using=self._db(using)):
+            self.apply(old, -1, using)
+            self.apply(new, 1, using)
+
+    def _deleted(self, sender, instance, using, **kwargs):
+        old = instance.__dict__.get(OLD_ROWS, {}).pop(self.name, ())
+        self.apply(old, -1, using)
+
+    def connect(self):
+        """
+        Update the groups when rows of the model are saved or deleted.
+        """
+        uid = 'django_group_by.materialized.{}'.format(self.name)
+        pre_save.connect(self._store_old, sender=self.model, dispatch_uid=uid)
+        post_save.connect(self._saved, sender=self.model, dispatch_uid=uid)
+        pre_delete.connect(self._store_old, sender=self.model, dispatch_uid=uid)
+        post_delete.connect(self._deleted, sender=self.model, dispatch_uid=uid)
+
+    def disconnect(self):
+        uid = 'django_group_by.materialized.{}'.format(self.name)
+        for signal in (pre_save, post_save, pre_delete, post_delete):
+            signal.disconnect(sender=self.model, dispatch_uid=uid)
+
+
+def register(name, queryset, fields, annotations, timestamp=None, signals=True):
+    """
+    Declare a materialized aggregate, usually in an AppConfig.ready().
+
+    :param name: unique name of the aggregate
+    :param queryset: model or base queryset (filtered) to aggregate
+    :param fields: fields to group by, expanded as in group_by()
+    :param annotations: dict of Count and Sum aggregates by alias
+    :param timestamp: field with the time of the last change of each row,
+        for catch_up()
+    :param signals: update the groups on post_save and post_delete
+    :return: MaterializedAggregate instance
+    """
+    if not hasattr(queryset, 'query'):
+        queryset = queryset._base_manager.all()
+    aggregate = MaterializedAggregate(name, queryset, fields, annotations, timestamp)
+    unregister(name)
+    registry[name] = aggregate
+    if signals:
+        aggregate.connect()
+    return aggregate
+
+
+def unregister(name):
+    """
+    Remove the materialized aggregate (its summary rows are kept).
+    """
+    aggregate = registry.pop(name, None)
+    if aggregate is not None:
+        aggregate.disconnect()
+
+
+def materialized(name, using=None):
+    """
+    Get the current rows of the materialized aggregate.
+    """
+    return registry[name].rows(using)
@@ -2,7 +2,24 @@
 This module contains the final mixin implementation, for whatever version
 of Django is present.
 """
+import sys
+
+from django.apps import apps
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.db.models import ForeignKey, ManyToManyField
+from django.utils import six
+
+from .cache import fields_cache
+from .columns import fetch_columns
+from .export import export_rows
+from .keyset import estimate_count, page_rows
+from .m2m import m2m_rows
+from .options import get_options, set_options
+from .parallel import parallel_rows
+from .plan import RowPlan
+from .rows import decode_rows
+from .spill import spill_rows
+from .window import top_n_rows
 
 try:
     # Django 1.9+
@@ -12,26 +29,195 @@ except ImportError:
     # Django 1.8-
     from .queryset import GroupByQuerySetMixinBase as GroupByMixinBase
 
+if sys.version_info >= (3, 6):
+    # Async iteration, requires async generators
+    from .aio import GroupByAsyncMixin
+
+else:
+    GroupByAsyncMixin = object
+
 
-class GroupByMixin(GroupByMixinBase):
+class GroupByMixin(GroupByMixinBase, GroupByAsyncMixin):
     """
     QuerySet mixin that adds a group_by() method, similar to values() but
     which returns AggregatedGroup instances when iterated instead of
     dictionaries.
+
+    On Python 3.6+ querysets can also be iterated asynchronously, with
+    "async for" or "await queryset.alist()".
     """
+    def cached(self, timeout=DEFAULT_TIMEOUT, backend='default'):
+        """
+        Clone the group_by queryset caching its raw rows in the cache backend,
+        keyed by the compiled SQL. Entries are invalidated when any model
+        used by the query is saved or deleted.
+
+        :param timeout: cache timeout, backend's default if not given
+        :param backend: name of the cache backend
+        :return: cloned queryset
+        """
+        self._group_by_field_names()
+        clone = self._clone()
+        set_options(clone.query, {'cache': (backend, timeout)})
+        return clone
+
+    def columns(self, chunk_size=None):
+        """
+        Evaluate the group_by queryset into columns instead of rows, without
+        building any objects per row.
+
+        :param chunk_size: rows fetched at a time
+        :return: OrderedDict with a column per expanded field, extra select
+            and annotation; NumPy arrays for numeric columns if available,
+            array.array or list otherwise
+        """
+        return fetch_columns(self, self._group_by_field_names(), chunk_size)
+
+    def export(self, fmt='csv', stream=None, chunk_size=None):
+        """
+        Export the group_by queryset as CSV (with a header row) or JSON Lines,
+        formatted straight from the raw rows without building any objects.
+
+        :param fmt: 'csv' or 'jsonl'
+        :param stream: file-like object to write to, if not given a generator
+            of strings is returned (e.g. for a StreamingHttpResponse)
+        :param chunk_size: rows fetched and formatted at a time
+        :return: generator of strings if no stream is given
+        """
+        chunks = export_rows(self, self._group_by_field_names(), fmt, chunk_size)
+        if stream is None:
+            return chunks
+        for chunk in chunks:
+            stream.write(chunk)
+
+    def page_after(self, cursor=None, size=20, count=None):
+        """
+        Get a page of the group_by queryset ordered by its group keys (the
+        expanded fields, or just the primary keys of related instances),
+        seeking past the key of the previous page's last row instead of
+        using an offset.
+
+        :param cursor: next_cursor of the previous page, None for the first
+        :param size: rows per page
+        :param count: 'exact' or 'estimate' (see estimated_count) to also
+            get the number of rows of all the pages
+        :return: KeysetPage, with the rows, next_cursor and count
+        """
+        return page_rows(self, self._group_by_field_names(), cursor, size, count)
+
+    def estimated_count(self):
+        """
+        Get the number of rows of the group_by queryset as estimated by the
+        database planner, without running it (PostgreSQL), or the exact
+        count on other databases.
+        """
+        self._group_by_field_names()
+        return estimate_count(self)
+
+    def parallel(self, partition_by, workers=4, bounds=None, partitions=None):
+        """
+        Evaluate the group_by queryset split in ranges of a field, running
+        them at the same time on separate connections, and merge the partial
+        aggregates (Count, Sum, Min, Max and Avg) by group key.
+
+        Each thread uses its own connection, so data written in the current
+        transaction is not seen (unless workers is 1).
+
+        :param partition_by: field (or lookup path) to split the rows by,
+            numeric or date
+        :param workers: number of threads
+        :param bounds: (min, max) values of the field to split, those of the
+            whole table if not given
+        :param partitions: number of ranges, as many as workers if not given
+        :return: list of rows, like iterating the queryset
+        """
+        return parallel_rows(self, self._group_by_field_names(), partition_by,
+                             workers, bounds, partitions)
+
+    def spill(self, directory=None, chunk_size=None):
+        """
+        Evaluate the group_by queryset into a memory mapped temporary file,
+        fetching and writing its raw rows a chunk at a time. Rows are only
+        decoded when accessed, so resident memory stays bounded.
+
+        :param directory: directory of the temporary file, the system's
+            default if not given
+        :param chunk_size: rows fetched (and decoded when iterating) at a time
+        :return: SpilledResult, a sequence of rows that can be indexed,
+            sliced and iterated again; close it to remove the file
+        """
+        return spill_rows(self, self._group_by_field_names(), directory, chunk_size)
+
+    def top_n(self, n, order_by, per):
+        """
+        Get the first n rows of the group_by queryset by order_by, for every
+        distinct value of the per fields, in a single query (with a window
+        function if the database supports it).
+
+        :param n: rows per partition
+        :param order_by: name (or list of names, '-' for descending) of the
+            grouped fields or annotations to rank by
+        :param per: fields to partition by, as given to group_by
+        :return: list of rows, ordered by the per fields and rank
+        """
+        field_names = self._group_by_field_names()
+        if isinstance(per, six.string_types):
+            per = [per]
+
+        # Grouped columns of the fields, whether FKs were pruned or not
+        columns = (self._get_group_by_fields(self.model, per) +
+                   self._get_group_by_fields(self.model, per, ()))
+        per = [c for i, c in enumerate(columns) if c in field_names and c not in columns[:i]]
+        if not per:
+            raise ValueError('Can only partition by grouped fields.')
+
+        rows = top_n_rows(self, field_names, n, order_by, per)
+        options = get_options(self.query)
+        if options['m2m']:
+            rows = m2m_rows(self, field_names, options['m2m'], rows)
+        plan = RowPlan.for_query(self.model, self.query, field_names)
+        return decode_rows(plan, rows, self.db, options)
+
     @classmethod
-    def _expand_group_by_fields(cls, model, fields):
+    def _get_group_by_fields(cls, model, fields, only=None):
+        """
+        Get the (cached) expanded fields for the model and fields.
+
+        :param fields: fields to "group by"
+        :param only: related fields to select for FKs, see expansion
+        :return: expanded fields
+        """
+        if only is not None:
+            only = tuple(only)
+        key = (model, tuple(fields), only)
+        res = fields_cache.get(key)
+        if res is None:
+            res = tuple(cls._expand_group_by_fields(model, fields, only))
+            fields_cache.set(key, res)
+        return res
+
+    @classmethod
+    def _expand_group_by_fields(cls, model, fields, only=None):
         """
         Expand FK fields into all related object's fields to avoid future
         lookups.
 
+        If only is given, FK fields are expanded into their primary key only
+        (no join required), plus the related fields in only (e.g.
+        'author__name'), and all other related fields are deferred.
+
         :param fields: fields to "group by"
+        :param only: related fields to select for FKs (pruning mode)
         :return: expanded fields
         """
         # Containers for resulting fields and related model fields
         res = []
         related = {}
 
+        # Selected related fields are grouped too
+        if only is not None:
+            fields = list(fields) + [f for f in only if f not in fields]
+
         # Add own fields and populate related fields
         for field_name in fields:
             if '__' in field_name:
@@ -50,9 +236,15 @@ class GroupByMixin(GroupByMixinBase):
                     # It's a related field, get model
                     related_model = model_field.related_model
 
-                    # Append all its fields with the correct prefix
-                    res.extend('{}__{}'.format(field_name, f.column)
-                               for f in related_model._meta.fields)
+                    if only is not None:
+                        # Pruning, append only its primary key
+                        res.append('{}__{}'.format(field_name,
+                                                   related_model._meta.pk.column))
+
+                    else:
+                        # Append all its fields with the correct prefix
+                        res.extend('{}__{}'.format(field_name, f.column)
+                                   for f in related_model._meta.fields)
 
                 else:
                     # It's a common field, just append it
@@ -64,11 +256,29 @@ class GroupByMixin(GroupByMixinBase):
             fk = model._meta.get_field(fk_field_name)
 
             # Get all fields for that related model
-            related_fields = cls._expand_group_by_fields(fk.related_model,
-                                                         field_names)
+            related_fields = cls._expand_group_by_fields(
+                fk.related_model, field_names, None if only is None else ())
 
             # Append them with the correct prefix
             res.extend('{}__{}'.format(fk_field_name, f) for f in related_fields)
 
         # Return all fields
         return res
+
+
+def warm_group_by_cache(signatures):
+    """
+    Populate the expansion and row plan caches for the given group_by
+    signatures, usually from an AppConfig.ready() method.
+
+    :param signatures: iterable of (model, fields) pairs, where the model
+        can also be given as an 'app_label.ModelName' string, or of
+        (model, fields, only) triples for pruned FKs
+    """
+    for signature in signatures:
+        model, fields = signature[:2]
+        only = signature[2] if len(signature) > 2 else None
+        if not isinstance(model, type):
+            model = apps.get_model(model)
+        fields = GroupByMixin._get_group_by_fields(model, fields, only)
+        RowPlan.get(model, fields)
@@ -0,0 +1,26 @@
+"""
+This module contains the models of the materialized aggregates (see
+materialized.py), only available with django_group_by in INSTALLED_APPS.
+"""
+from django.db import models
+
+
+class GroupSummary(models.Model):
+    """
+    Current values of one group of a materialized aggregate, serialized as
+    a JSON list in select order (plus the number of rows in the group).
+    """
+    name = models.CharField(max_length=100)
+    key = models.CharField(max_length=32)
+    values = models.TextField()
+
+    class Meta(object):
+        unique_together = ('name', 'key')
+
+
+class SummaryCheckpoint(models.Model):
+    """
+    Last timestamp caught up by a materialized aggregate.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    timestamp = models.TextField()
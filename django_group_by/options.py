@@ -0,0 +1,43 @@
+"""
+This module contains the group_by options, which are stored in the query
+context so that they are kept when the queryset is cloned.
+"""
+CONTEXT_KEY = 'group_by_options'
+
+# Available options with their default values
+DEFAULTS = {
+    'cache': None,
+    'chunk_size': None,
+    'hydrate': None,
+    'identity_map': False,
+    'lazy_related': False,
+    'm2m': None,
+    'rollup': None,
+    'row_factory': None,
+}
+
+
+def get_options(query):
+    """
+    Get the group_by options of the query (defaults if none were set).
+    """
+    return query.get_context(CONTEXT_KEY) or DEFAULTS
+
+
+def set_options(query, options):
+    """
+    Update the group_by options of the query with the given ones.
+    """
+    unknown = set(options) - set(DEFAULTS)
+    if unknown:
+        raise TypeError("group_by() got unexpected keyword arguments: {}".format(
+            ', '.join(sorted(unknown))))
+    if options.get('hydrate') not in (None, 'batch', 'auto', 'dimensions'):
+        raise ValueError("Unknown hydrate mode: {!r}".format(options['hydrate']))
+    if options.get('rollup') and options.get('m2m'):
+        raise ValueError("Can't compute subtotals with many to many lists.")
+
+    # Always replace the dict, since clones share it
+    merged = dict(get_options(query))
+    merged.update(options)
+    query.add_context(CONTEXT_KEY, merged)
@@ -0,0 +1,240 @@
+"""
+This module contains the parallel execution of group_by querysets: the
+query is split by ranges of a field, the partial aggregates are computed
+at the same time on separate connections and then merged by group key.
+"""
+from __future__ import division
+
+import threading
+from functools import partial
+
+from django.db import connections
+from django.db.models import Avg, Count, Max, Min, Sum
+
+from .m2m import m2m_rows
+from .options import get_options
+from .plan import RowPlan, query_names
+from .rows import decode_rows
+
+
+def _add(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+
+def _min(a, b):
+    return a if b is None or (a is not None and a <= b) else b
+
+
+def _max(a, b):
+    return a if b is None or (a is not None and a >= b) else b
+
+
+# Merge functions of partial aggregates, by aggregate class (Avg apart)
+MERGES = (
+    (Count, _add),
+    (Sum, _add),
+    (Min, _min),
+    (Max, _max),
+)
+
+
+def _merge_function(name, annotation):
+    """
+    Get the function that merges two partial values of the aggregate.
+    """
+    distinct = getattr(annotation, 'distinct', None) or annotation.extra.get('distinct')
+    if not distinct:
+        for aggregate, merge in MERGES:
+            if type(annotation) is aggregate:
+                return merge
+    raise ValueError("Can't merge partial results of {!r} ({}), only Count, Sum, Min, "
+                     "Max and Avg are supported.".format(name, annotation))
+
+
+def partition_bounds(queryset, partition_by, partitions, bounds=None):
+    """
+    Split the range of values of the field (the whole table's, unless bounds
+    are given) into at most the given number of ranges, returned as lookups
+    (plus one for NULL).
+    """
+    if bounds is None:
+        manager = queryset.model._base_manager.using(queryset.db)
+        values = manager.aggregate(low=Min(partition_by), high=Max(partition_by))
+        bounds = values['low'], values['high']
+    low, high = bounds
+
+    # Boundaries between ranges (without repetitions for small ranges)
+    boundaries = []
+    if low is not None:
+        try:
+            for i in range(1, partitions):
+                boundary = low + (high - low) * i // partitions
+                if boundary > low and boundary not in boundaries:
+                    boundaries.append(boundary)
+        except TypeError:
+            raise ValueError("Can't split the values of {!r} in ranges.".format(partition_by))
+
+    # Ranges between boundaries, the first and last ones open, plus NULL
+    lookups = []
+    for start, end in zip([None] + boundaries, boundaries + [None]):
+        lookup = {}
+        if start is not None:
+            lookup[partition_by + '__gte'] = start
+        if end is not None:
+            lookup[partition_by + '__lt'] = end
+        lookups.append(lookup)
+    lookups.append({partition_by + '__isnull': True})
+    return lookups
+
+
+def run_tasks(tasks, workers):
+    """
+    Call the functions and get their results (in order), in the given number
+    of threads (each with its own connections) or in the current one if
+    just one. The first error is raised once all threads are done.
+    """
+    if workers <= 1:
+        return [task() for task in tasks]
+
+    results = [None] * len(tasks)
+    pending = list(enumerate(tasks))
+    errors = []
+    lock = threading.Lock()
+
+    def work():
+        try:
+            while not errors:
+                with lock:
+                    if not pending:
+                        return
+                    index, task = pending.pop(0)
+                results[index] = task()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    threads = [threading.Thread(target=work) for _ in range(min(workers, len(tasks)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def _fetch_rows(query, db):
+    return list(query.get_compiler(db).results_iter())
+
+
+def _fetch_partitions(queries, db, workers):
+    """
+    Execute the queries and get their rows, at the same time (see run_tasks).
+    """
+    return run_tasks([partial(_fetch_rows, query, db) for query in queries], workers)
+
+
+def _sort_rows(rows, names, order_by):
+    """
+    Sort the merged rows by the ordering of the query, which can only have
+    selected names (NULL values go first).
+    """
+    for ordering in reversed(order_by):
+        name = ordering.lstrip('-') if hasattr(ordering, 'lstrip') else None
+        if name not in names:
+            raise ValueError("Can't order merged results by {!r}, only by selected "
+                             "names.".format(ordering))
+        index = names.index(name)
+        rows.sort(key=lambda row: (row[index] is not None, row[index]),
+                  reverse=ordering.startswith('-'))
+    return rows
+
+
+def parallel_rows(queryset, field_names, partition_by, workers=4, bounds=None,
+                  partitions=None):
+    """
+    Evaluate the group_by queryset in parallel, split in ranges of the
+    partition_by field, and get the merged results as grouped rows.
+    """
+    query = queryset.query
+    if get_options(query)['rollup']:
+        raise ValueError("Can't merge partial results of queries with subtotals.")
+
+    # Filters on aggregates (HAVING, apart on Django 1.8) need whole groups
+    if query.where.contains_aggregate or getattr(query, 'having', None):
+        raise ValueError("Can't merge partial results of queries filtered by aggregates.")
+    names, _ = query_names(query, field_names)
+
+    # How to merge every aggregate column, the rest are the group key
+    part = queryset._clone()
+    part.query.clear_limits()
+    part.query.clear_ordering(force_empty=True)
+    merges = []
+    averages = []
+    for name, annotation in query.annotation_select.items():
+        if not annotation.contains_aggregate:
+            continue
+        index = names.index(name)
+        if type(annotation) is Avg:
+            # Partial sum and count instead, they are added up
+            source = annotation.get_source_expressions()[0]
+            count_name = '{}__parallel_count'.format(name)
+            part = part.annotate(**{count_name: Count(source)})
+            part.query.annotations[name] = Sum(source).resolve_expression(part.query)
+            merges.append((index, _add))
+            averages.append((index, len(names) + len(averages)))
+        else:
+            merges.append((index, _merge_function(name, annotation)))
+    for _, count_index in averages:
+        merges.append((count_index, _add))
+    merged = set(index for index, _ in merges)
+    keys = [i for i in range(len(names)) if i not in merged]
+
+    # Rows of every range, fetched at the same time
+    queries = [part.filter(**lookup).query
+               for lookup in partition_bounds(queryset, partition_by, partitions or workers, bounds)]
+    partitions = _fetch_partitions(queries, queryset.db, workers)
+
+    if merges or query.distinct:
+        # Merge partial rows by group key
+        groups = {}
+        rows = []
+        for partition in partitions:
+            for row in partition:
+                key = tuple(row[i] for i in keys)
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = list(row)
+                    rows.append(group)
+                else:
+                    for index, merge in merges:
+                        group[index] = merge(group[index], row[index])
+
+        # Averages from the added sums and counts
+        for row in rows:
+            for index, count_index in averages:
+                count = row[count_index]
+                row[index] = float(row[index]) / count if count else None
+        rows = [tuple(row[:len(names)]) for row in rows]
+
+    else:
+        # Not grouped (just values), partitions are simply put together
+        rows = [tuple(row) for partition in partitions for row in partition]
+
+    # Ordering and limits of the query applied to the merged rows
+    rows = _sort_rows(rows, names, query.order_by)
+    if query.low_mark or query.high_mark is not None:
+        rows = rows[query.low_mark:query.high_mark]
+
+    # Decode like when iterating the queryset
+    options = get_options(query)
+    if options['m2m']:
+        rows = m2m_rows(queryset, field_names, options['m2m'], rows)
+    plan = RowPlan.for_query(queryset.model, query, field_names)
+    return decode_rows(plan, rows, queryset.db, options)
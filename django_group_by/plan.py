@@ -0,0 +1,441 @@
+"""
+This module contains the row plan, which is compiled once per query and
+then used to decode every row by column index.
+"""
+from operator import itemgetter
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import ForeignKey
+
+try:
+    # Django 1.10+
+    from django.db.models.base import DEFERRED
+    deferred_class_factory = None
+
+except ImportError:
+    # Django 1.9-
+    from django.db.models.query_utils import deferred_class_factory
+    DEFERRED = None
+
+from .cache import plan_cache
+from .group import AggregatedGroup, LazyRelatedAttribute, PendingRelated
+from .options import get_options
+
+# Column with the number of grouped fields of each rollup row
+ROLLUP_LEVEL = 'rollup_level'
+
+
+def query_names(query, field_names):
+    """
+    Get the column names of a values query (in select order) and the names
+    that are not fields (extra selects and annotations).
+    """
+    extra_names = list(query.extra_select)
+    annotation_names = list(query.annotation_select)
+    names = extra_names + list(field_names) + annotation_names
+    return names, extra_names + annotation_names
+
+
+def resolve_model(model, path):
+    """
+    Follow the relation path from the model, returning the related model
+    or None if the path does not lead to one (or there is no model).
+    """
+    if model is None:
+        return None
+    for attr in path.split('__'):
+        try:
+            field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            return None
+        model = field.related_model if field.is_relation else None
+        if model is None:
+            return None
+    return model
+
+
+def resolve_field(model, name):
+    """
+    Follow the lookup path from the model, returning the final field or None
+    if it cannot be resolved.
+    """
+    if '__' in name:
+        path, name = name.rsplit('__', 1)
+        model = resolve_model(model, path)
+        if model is None:
+            return None
+    try:
+        return model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+
+
+def resolve_fk_model(model, path):
+    """
+    Follow the path from the model through foreign keys only, returning the
+    related model or None if any step is not a foreign key.
+    """
+    for attr in path.split('__'):
+        try:
+            field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            return None
+        if not isinstance(field, ForeignKey):
+            return None
+        model = field.related_model
+    return model
+
+
+def cache_setter(field):
+    """
+    Get a function that sets the related instance of the FK field in the
+    field's cache of an instance, as Django does when following it.
+    """
+    if hasattr(field, 'set_cached_value'):
+        # Django 2.0+
+        return field.set_cached_value
+    cache_name = field.get_cache_name()
+    return lambda obj, value: setattr(obj, cache_name, value)
+
+
+def column_setter(field):
+    """
+    Get a function that sets the related instance of the FK field like
+    cache_setter, and the FK column too (from the related instance, if it
+    was loaded), for intermediate instances that were built without it.
+    """
+    set_cached = cache_setter(field)
+    attname = field.attname
+    related_attname = field.foreign_related_fields[0].attname
+
+    def setter(obj, value):
+        if value is None:
+            setattr(obj, attname, None)
+        elif related_attname in value.__dict__:
+            setattr(obj, attname, value.__dict__[related_attname])
+        set_cached(obj, value)
+
+    return setter
+
+
+def link_related(setter, parent, child):
+    """
+    Link the child instance to its parent with the setter, waiting for the
+    parent to be built if it's pending (nothing to link if it's None).
+    """
+    if parent is None:
+        return
+    if parent.__class__ is PendingRelated:
+        parent.link(setter, child)
+    else:
+        if child.__class__ is PendingRelated:
+            child = child.build()
+        setter(parent, child)
+
+
+class RelatedTarget(object):
+    """
+    Decoding instructions for a related model instance in a grouped row:
+    the attribute to set, the model class and the columns to init it with.
+
+    Instances are built with Model.from_db, with values in concrete field
+    order and deferred fields for the columns that were not grouped.
+    """
+    def __init__(self, attr, model, field_names, indexes):
+        self.attr = attr
+        self.model = model
+        self.field_names = tuple(field_names)
+        self.indexes = tuple(indexes)
+
+        # Getter for the values, always returning a tuple
+        if len(self.indexes) == 1:
+            index = self.indexes[0]
+            self.getter = lambda row: (row[index],)
+        else:
+            self.getter = itemgetter(*self.indexes)
+
+        # Position of the primary key, if grouped by it (None FK detection)
+        pk_name = model._meta.pk.attname
+        if pk_name in self.field_names:
+            self.pk_position = self.field_names.index(pk_name)
+        else:
+            self.pk_position = None
+
+        # Instantiation method, from_db if all columns are concrete fields
+        self._init_from_db()
+
+    def _init_from_db(self):
+        """
+        Resolve the positions of the values in concrete field order, and the
+        (deferred) class and attribute names to use with Model.from_db.
+        """
+        opts = self.model._meta
+        attnames = []
+        for name in self.field_names:
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                field = None
+            if field is None or field not in opts.concrete_fields:
+                # Not a concrete field (or unknown), init with kwargs
+                self.instantiate = self._instantiate_kwargs
+                return
+            attnames.append(field.attname)
+
+        # Position of each concrete field's value (None if deferred)
+        positions = tuple(attnames.index(f.attname) if f.attname in attnames
+                          else None for f in opts.concrete_fields)
+
+        if positions == tuple(range(len(attnames))):
+            # All fields in order, pass values as they are
+            self.from_db_class = self.model
+            self.from_db_names = tuple(attnames)
+            self.instantiate = self._instantiate_from_db
+
+        elif DEFERRED is not None:
+            # Django 1.10+: reorder, deferred fields marked as DEFERRED
+            self.from_db_class = self.model
+            self.from_db_names = tuple(f.attname for f in opts.concrete_fields)
+            self.positions = positions
+            self.instantiate = self._instantiate_deferred
+
+        else:
+            # Django 1.9-: reorder loaded fields, use a deferred class
+            loaded = [(p, f.attname) for p, f in zip(positions, opts.concrete_fields)
+                      if p is not None]
+            skip = set(f.attname for f in opts.concrete_fields) - set(attnames)
+            self.from_db_class = deferred_class_factory(self.model, skip)
+            self.from_db_names = tuple(a for _, a in loaded)
+            self.positions = tuple(p for p, _ in loaded)
+            self.instantiate = self._instantiate_deferred
+
+    def _instantiate_kwargs(self, values, db):
+        obj = self.model(**dict(zip(self.field_names, values)))
+        obj._state.adding = False
+        obj._state.db = db
+        return obj
+
+    def _instantiate_from_db(self, values, db):
+        return self.from_db_class.from_db(db, self.from_db_names, values)
+
+    def _instantiate_deferred(self, values, db):
+        values = [DEFERRED if p is None else values[p] for p in self.positions]
+        return self.from_db_class.from_db(db, self.from_db_names, values)
+
+    def build(self, row, db=None, identities=None):
+        """
+        Build the related instance from the row, or None if the FK is None.
+        """
+        return self.build_values(self.getter(row), db, identities)
+
+    def build_values(self, values, db=None, identities=None):
+        """
+        Build the related instance from its own values (in field_names order),
+        reusing the one in the identities map (by model and pk) if given.
+        """
+        # If we grouped by ID and it's None, then the FK is None
+        if self.pk_position is None:
+            return self.instantiate(values, db)
+        pk = values[self.pk_position]
+        if pk is None:
+            return None
+
+        # Without identity map, simply instantiate
+        if identities is None:
+            return self.instantiate(values, db)
+
+        # Otherwise get it from the map, or instantiate and add it
+        key = (self.model, pk)
+        obj = identities.get(key)
+        if obj is None:
+            obj = identities[key] = self.instantiate(values, db)
+        return obj
+
+    def defer(self, row, db=None, identities=None):
+        """
+        Get the pending values to build the related instance on access, or
+        None if the FK is None.
+        """
+        values = self.getter(row)
+        if self.pk_position is not None and values[self.pk_position] is None:
+            return None
+        return PendingRelated(self, values, db, identities)
+
+
+class IntermediateTarget(RelatedTarget):
+    """
+    Related instance of a path that was not grouped by, built only to link
+    the nested instances to (e.g. row.author for 'author__nationality__name').
+    It has no primary key and all its other fields are deferred.
+    """
+    def __init__(self, attr, model):
+        super(IntermediateTarget, self).__init__(attr, model, [model._meta.pk.attname], [0])
+
+        # No columns, always built with a None primary key
+        self.getter = lambda row: (None,)
+        self.pk_position = None
+
+
+class RowPlan(object):
+    """
+    Decoding plan for the rows of a grouped query, which maps every column
+    index to either an own attribute or a related model instance. Nested
+    related instances are also linked to their parent instances.
+
+    With lazy_related, related instances are only built on first access.
+    """
+    def __init__(self, model, names, annotation_names=(), lazy_related=False):
+        self.model = model
+        self.names = tuple(names)
+        self.lazy_related = lazy_related
+
+        # Containers for own attributes and related values (by path)
+        self.own = []
+        related = {}
+
+        # Resolve every column once, annotations are always own attributes
+        annotation_names = set(annotation_names)
+        for index, name in enumerate(self.names):
+            attrs = name.rsplit('__', 1)
+            if len(attrs) == 2 and name not in annotation_names:
+                # Related model field, store in path
+                path, field_name = attrs
+                related.setdefault(path, []).append((field_name, index))
+
+            else:
+                # Own model field, store directly
+                self.own.append((name, index))
+
+        # Resolve related paths into models, or nested dicts if not models
+        self.related = []
+        self.nested = []
+        paths = []
+        for path, columns in related.items():
+            rel_model = resolve_model(model, path)
+            field_names = [f for f, _ in columns]
+            indexes = [i for _, i in columns]
+            if rel_model is None:
+                # Not a model, maybe it is a dict field (?)
+                self.nested.append((path, tuple(field_names), tuple(indexes)))
+
+            else:
+                # Model, shorten the attribute name
+                attr = path.replace('__', '_')
+                self.related.append(RelatedTarget(attr, rel_model,
+                                                  field_names, indexes))
+                paths.append(path)
+
+        # Paths through FKs that were not grouped by get intermediate
+        # instances, for the nested ones to be linked to (also added paths)
+        for path in paths:
+            if '__' not in path:
+                continue
+            parent_path = path.rsplit('__', 1)[0]
+            if parent_path in paths or resolve_fk_model(model, path) is None:
+                continue
+            self.related.append(IntermediateTarget(parent_path.replace('__', '_'),
+                                                   resolve_fk_model(model, parent_path)))
+            paths.append(parent_path)
+
+        # Nested instances are also linked to their parents through the FK
+        # cache (e.g. row.author.nationality), by position in related
+        self.links = []
+        for child, path in enumerate(paths):
+            if '__' not in path:
+                continue
+            parent_path, name = path.rsplit('__', 1)
+            if parent_path not in paths:
+                continue
+            parent = paths.index(parent_path)
+            field = self.related[parent].model._meta.get_field(name)
+            if isinstance(field, ForeignKey):
+                # Intermediate instances don't have the FK column either
+                if isinstance(self.related[parent], IntermediateTarget):
+                    self.links.append((parent, child, column_setter(field)))
+                else:
+                    self.links.append((parent, child, cache_setter(field)))
+        self.links = tuple(self.links)
+
+        # Group class for this shape, attributes in decoding order
+        attrs = ([name for name, _ in self.own] +
+                 [path for path, _, _ in self.nested] +
+                 [target.attr for target in self.related])
+        lazy = [target.attr for target in self.related] if lazy_related else []
+        self.group_class = AggregatedGroup.shape(model, attrs, lazy)
+
+        # Related builders, deferred only where the attribute is lazy
+        self.builders = tuple(
+            target.defer if isinstance(self.group_class.__dict__.get(target.attr),
+                                       LazyRelatedAttribute)
+            else target.build
+            for target in self.related
+        )
+
+    @classmethod
+    def get(cls, model, names, own_names=(), lazy_related=False):
+        """
+        Get the (cached) plan for the model and column names.
+        """
+        key = (model, tuple(names), tuple(own_names), lazy_related)
+        plan = plan_cache.get(key)
+        if plan is None:
+            plan = cls(model, names, own_names, lazy_related)
+            plan_cache.set(key, plan)
+        return plan
+
+    @classmethod
+    def for_query(cls, model, query, field_names):
+        """
+        Get the (cached) plan for a query, given its values field names.
+        """
+        names, own_names = query_names(query, field_names)
+        options = get_options(query)
+        if options['rollup']:
+            # Plus the level of every row (subtotals have less fields)
+            names.append(ROLLUP_LEVEL)
+            own_names.append(ROLLUP_LEVEL)
+        if options['m2m']:
+            # Plus the lists of many to many instances, fetched apart
+            names.extend(options['m2m'])
+            own_names.extend(options['m2m'])
+        return cls.get(model, names, own_names, options['lazy_related'])
+
+    def decoder(self, db=None, identity_map=False):
+        """
+        Get a function that decodes row tuples into AggregatedGroup instances,
+        for one execution of the query on the given database.
+
+        With identity_map, related instances with the same model and pk are
+        shared by all the rows decoded by the function. It can also be the
+        dict to use as map, possibly pre-filled (see hydrate.py).
+        """
+        if isinstance(identity_map, dict):
+            identities = identity_map
+        else:
+            identities = {} if identity_map else None
+        own_indexes = tuple(index for _, index in self.own)
+        nested = self.nested
+        builders = self.builders
+        links = self.links
+        make = self.group_class._make
+
+        def decode(row):
+            # Own values, then nested dicts, then related instances
+            values = [row[index] for index in own_indexes]
+            for _, field_names, indexes in nested:
+                values.append(dict((f, row[i]) for f, i in zip(field_names, indexes)))
+            related = [build(row, db, identities) for build in builders]
+
+            # Link nested instances to their parents
+            for parent, child, setter in links:
+                link_related(setter, related[parent], related[child])
+            values.extend(related)
+            return make(values)
+
+        return decode
+
+    def decode(self, row, db=None):
+        """
+        Decode a single row tuple into an AggregatedGroup instance.
+        """
+        return self.decoder(db)(row)
@@ -4,7 +4,12 @@ need a customized ValuesQuerySet.
 """
 from django.db.models.query import ValuesQuerySet
 
-from .group import AggregatedGroup
+from .fetch import grouped_rows
+from .instrument import QueryStats, instrumented
+from .m2m import split_m2m_fields
+from .options import get_options, set_options
+from .plan import RowPlan
+from .rows import iter_decoded
 
 
 class GroupByQuerySet(ValuesQuerySet):
@@ -13,17 +18,22 @@ class GroupByQuerySet(ValuesQuerySet):
     of dictionaries, which resemble the queryset's model in that all foreign
     related field values become actual model instances.
     """
-    def iterator(self):
-        # Same as in django
-        extra_names = list(self.query.extra_select)
-        field_names = self.field_names
-        annotation_names = list(self.query.annotation_select)
-        names = extra_names + field_names + annotation_names
-
-        # Iterate results and yield AggregatedGroup instances
-        for row in self.query.get_compiler(self.db).results_iter():
-            data = dict(zip(names, row))
-            obj = AggregatedGroup(self.model, data)
+    def iterator(self, chunk_size=None):
+        # Get the (cached) row plan and options once
+        plan = RowPlan.for_query(self.model, self.query, self.field_names)
+        options = get_options(self.query)
+
+        # Fetch in chunks if given here or as option
+        chunk_size = chunk_size or options['chunk_size']
+
+        # Measure only if there are receivers for the stats
+        stats = None
+        if instrumented(self.model):
+            stats = QueryStats(self.model, self.db, len(self.field_names))
+
+        # Raw rows as set by the options, then decoded by the row factory
+        rows = grouped_rows(self, self.field_names, chunk_size, bool(chunk_size), stats=stats)
+        for obj in iter_decoded(plan, rows, self.db, options, chunk_size, stats):
             yield obj
 
 
@@ -31,12 +41,46 @@ class GroupByQuerySetMixinBase(object):
     """
     Implementation of the group_by method using GroupByQuerySet.
     """
-    def group_by(self, *fields):
+    def group_by(self, *fields, **options):
         """
         Clone the queryset using GroupByQuerySet.
 
         :param fields:
+        :param options:
+            only: related fields to select, grouping FKs by primary key
+            hydrate: 'batch' to group FKs by primary key and fetch related
+                instances afterwards, one query per model; 'dimensions' to
+                take them from whole cached tables instead, or 'auto' to do
+                so only for FKs to small tables (see dimensions.py)
+            lazy_related: build related instances on first access
+            identity_map: share related instances with the same pk
+            chunk_size: fetch rows in chunks when iterating
+            row_factory: function returning the row builder, see rows.py
+            rollup: add subtotal rows for every prefix of the fields
+            m2m: 'batch' to fetch many to many fields apart, as lists of
+                related instances, instead of grouping by them
         :return:
         """
-        fields = self._expand_group_by_fields(self.model, fields)
-        return self._clone(klass=GroupByQuerySet, setup=True, _fields=fields)
+        only = options.pop('only', None)
+        if only is None and options.get('hydrate') is not None:
+            # FKs by primary key, related instances fetched (or taken) apart
+            only = ()
+        if options.get('m2m') is not None:
+            # Many to many fields are not grouped by, but fetched apart
+            fields, options['m2m'] = split_m2m_fields(self.model, fields, options['m2m'])
+        if options.get('rollup'):
+            # Columns of every field, the levels of the subtotals
+            options['rollup'] = tuple(self._get_group_by_fields(self.model, [f], only)
+                                      for f in fields)
+        fields = self._get_group_by_fields(self.model, fields, only)
+        clone = self._clone(klass=GroupByQuerySet, setup=True, _fields=fields)
+        set_options(clone.query, options)
+        return clone
+
+    def _group_by_field_names(self):
+        """
+        Get the values field names of a group_by queryset.
+        """
+        if not isinstance(self, GroupByQuerySet):
+            raise TypeError('Only available after calling group_by().')
+        return list(self.field_names)
@@ -0,0 +1,126 @@
+"""
+This module contains the result cache of group_by querysets, which stores
+the raw rows in Django's cache framework, keyed by the compiled SQL and
+invalidated by saves and deletes of the models touched by the query.
+"""
+import hashlib
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+try:
+    # Django 1.11+
+    from django.core.exceptions import EmptyResultSet
+
+except ImportError:
+    # Django 1.10-
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+from .cache import tables_cache
+
+KEY_PREFIX = 'django_group_by'
+
+# Backends cached results were read from in this process (also invalidated)
+used_backends = set()
+
+
+def table_models():
+    """
+    Get the (cached) map of table names to models, including auto-created
+    through models.
+    """
+    res = tables_cache.get('models')
+    if res is None:
+        res = dict((m._meta.db_table, m) for m in apps.get_models(include_auto_created=True))
+        tables_cache.set('models', res)
+    return res
+
+
+def touched_models(query):
+    """
+    Get the models whose tables are used by the query: the queryset's model
+    and every joined one (from grouped fields, filters or annotations).
+    """
+    tables = table_models()
+    models = set([query.model])
+    for alias in query.alias_map.values():
+        model = tables.get(alias.table_name)
+        if model is not None:
+            models.add(model)
+    return models
+
+
+def _generation_key(model):
+    opts = model._meta
+    return '{}:gen:{}.{}'.format(KEY_PREFIX, opts.app_label, opts.model_name)
+
+
+def generations(cache, models):
+    """
+    Get the current generation of every model, initializing missing ones to
+    a new unique value so that evicted generations never match old entries.
+    """
+    keys = sorted(_generation_key(m) for m in models)
+    values = cache.get_many(keys)
+    for key in keys:
+        if key not in values:
+            cache.add(key, int(time.time() * 1000000), None)
+            values[key] = cache.get(key)
+    return tuple((key, values[key]) for key in keys)
+
+
+def cache_backends():
+    """
+    Get the cache backends to invalidate: the ones in the GROUP_BY_CACHES
+    setting (for processes that write but don't read cached results) and
+    the ones used in this process.
+    """
+    return used_backends.union(getattr(settings, 'GROUP_BY_CACHES', ()))
+
+
+def invalidate(sender, **kwargs):
+    """
+    Bump the generation of the sender model in the cache backends, since
+    results using it may have been cached by any process.
+    """
+    # Nothing to do (no cache calls) unless results are cached
+    for backend in cache_backends():
+        cache = caches[backend]
+        key = _generation_key(sender)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Missing, a new one will be set on next read
+            pass
+
+
+def cached_rows(compiler, backend, timeout):
+    """
+    Get the rows of the compiled query from the cache, or execute it and
+    cache them if missing.
+    """
+    cache = caches[backend]
+    used_backends.add(backend)
+    models = touched_models(compiler.query)
+
+    # Key by database, SQL, params and generations of the touched models
+    try:
+        sql, params = compiler.as_sql()
+    except EmptyResultSet:
+        return []
+    data = repr((compiler.using, sql, tuple(params), generations(cache, models)))
+    key = '{}:rows:{}'.format(KEY_PREFIX, hashlib.md5(data.encode('utf-8')).hexdigest())
+
+    rows = cache.get(key)
+    if rows is None:
+        rows = [tuple(row) for row in compiler.results_iter()]
+        cache.set(key, rows, timeout)
+    return rows
+
+
+post_save.connect(invalidate, dispatch_uid='django_group_by.results')
+post_delete.connect(invalidate, dispatch_uid='django_group_by.results')
+m2m_changed.connect(invalidate, dispatch_uid='django_group_by.results')
@@ -0,0 +1,63 @@
+"""
+This module contains the built-in row factories. A row factory is called
+once per query execution with the row plan, the database alias and the
+group_by options, and returns the function called with every raw row.
+"""
+from collections import namedtuple
+
+from .cache import shape_cache
+from .hydrate import apply_hydrate
+
+
+def group_rows(plan, db, options):
+    """
+    AggregatedGroup instances, with related model instances (the default).
+    """
+    return plan.decoder(db, options['identity_map'])
+
+
+def tuple_rows(plan, db, options):
+    """
+    Plain tuples, in select order (see RowPlan.names).
+    """
+    return tuple
+
+
+def dict_rows(plan, db, options):
+    """
+    Dictionaries by column name, like values() does.
+    """
+    names = plan.names
+    return lambda row: dict(zip(names, row))
+
+
+def namedtuple_rows(plan, db, options):
+    """
+    Named tuples with the column names as fields (invalid names renamed).
+    """
+    key = (namedtuple, plan.names)
+    row_class = shape_cache.get(key)
+    if row_class is None:
+        row_class = namedtuple('Row', plan.names, rename=True)
+        shape_cache.set(key, row_class)
+    return row_class._make
+
+
+def iter_decoded(plan, rows, db, options, chunk_size=None, stats=None):
+    """
+    Iterate the raw rows decoded by the row factory, with their related
+    instances hydrated as set by the options (and measured if stats).
+    """
+    rows, options = apply_hydrate(plan, rows, db, options, chunk_size)
+    decode = (options['row_factory'] or group_rows)(plan, db, options)
+    if stats is not None:
+        return stats.iterate(plan, rows, decode)
+    return (decode(row) for row in rows)
+
+
+def decode_rows(plan, rows, db, options):
+    """
+    Decode the raw rows like iterating the queryset does (with batched
+    hydration if set), for modes that fetch them on their own.
+    """
+    return list(iter_decoded(plan, rows, db, options))
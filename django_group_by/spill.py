@@ -0,0 +1,201 @@
+"""
+This module contains the spilled result mode, which writes the raw rows of
+a group_by queryset to a local temporary file and maps it in memory, so
+that huge results can be accessed by index, sliced and iterated again with
+bounded resident memory, decoding rows only when they are accessed.
+"""
+import mmap
+import struct
+import tempfile
+from itertools import islice
+
+try:
+    from collections.abc import Sequence
+
+except ImportError:
+    # Python 2
+    from collections import Sequence
+
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+from django.utils import six
+from django.utils.six.moves import cPickle as pickle
+
+from .columns import column_typecodes
+from .options import get_options, set_options
+from .plan import RowPlan
+from .rows import decode_rows, tuple_rows
+
+# Offsets of the rows in the data file, one per row plus the end
+OFFSET = struct.Struct('<Q')
+
+# Row formats: numeric columns packed (with a null bitmap) and the rest
+# pickled, or the whole row pickled if a value does not fit its column
+PACKED = b'\x00'
+PICKLED = b'\x01'
+
+
+class RowCodec(object):
+    """
+    Binary encoding of the raw rows of a query, fixed-width for the numeric
+    columns (by array typecode: 'd' for floats, 64 bit integers otherwise).
+    """
+    def __init__(self, typecodes):
+        self.size = len(typecodes)
+        self.fixed = tuple(i for i, t in enumerate(typecodes) if t)
+        self.variable = tuple(i for i, t in enumerate(typecodes) if not t)
+
+        # Types each packed column takes exactly (e.g. no bools as integers)
+        self.types = tuple((float,) if typecodes[i] == 'd' else six.integer_types
+                           for i in self.fixed)
+        codes = ''.join('d' if typecodes[i] == 'd' else 'q' for i in self.fixed)
+        self.bitmap_size = (len(self.fixed) + 7) // 8
+        self.struct = struct.Struct('<{}s{}'.format(self.bitmap_size, codes))
+
+    def encode(self, row):
+        """
+        Encode the row tuple into bytes.
+        """
+        nulls = bytearray(self.bitmap_size)
+        values = []
+        for position, (index, types) in enumerate(zip(self.fixed, self.types)):
+            value = row[index]
+            if value is None:
+                nulls[position // 8] |= 1 << (position % 8)
+                value = 0
+            elif value.__class__ not in types:
+                return PICKLED + pickle.dumps(tuple(row), pickle.HIGHEST_PROTOCOL)
+            values.append(value)
+        try:
+            data = PACKED + self.struct.pack(bytes(nulls), *values)
+        except (struct.error, OverflowError):
+            # Out of range integers
+            return PICKLED + pickle.dumps(tuple(row), pickle.HIGHEST_PROTOCOL)
+        if self.variable:
+            data += pickle.dumps(tuple(row[i] for i in self.variable), pickle.HIGHEST_PROTOCOL)
+        return data
+
+    def decode(self, data):
+        """
+        Decode the bytes of an encoded row into the row tuple.
+        """
+        if data[:1] == PICKLED:
+            return pickle.loads(data[1:])
+
+        values = self.struct.unpack_from(data, 1)
+        nulls = bytearray(values[0])
+        row = [None] * self.size
+        for position, index in enumerate(self.fixed):
+            if not nulls[position // 8] & (1 << (position % 8)):
+                row[index] = values[position + 1]
+        if self.variable:
+            variable = pickle.loads(data[1 + self.struct.size:])
+            for index, value in zip(self.variable, variable):
+                row[index] = value
+        return tuple(row)
+
+
+class SpilledResult(Sequence):
+    """
+    Sequence of the rows of a group_by queryset, stored raw in a memory
+    mapped temporary file and decoded (like when iterating the queryset)
+    every time they are accessed.
+
+    Close it, or use it as a context manager, to remove the file.
+    """
+    def __init__(self, plan, codec, db, options, data, index, length, chunk_size):
+        self.plan = plan
+        self.codec = codec
+        self.db = db
+        self.options = options
+        self.chunk_size = chunk_size
+        self._files = (data, index)
+        self._length = length
+
+        # An empty file can't be mapped (no rows, nothing to read)
+        self._data = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ) if data.tell() else None
+        self._index = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __repr__(self):
+        return u'<SpilledResult for {}: {} rows>'.format(self.plan.model.__name__, self._length)
+
+    def __len__(self):
+        return self._length
+
+    def _raw(self, index):
+        start, = OFFSET.unpack_from(self._index, index * OFFSET.size)
+        end, = OFFSET.unpack_from(self._index, (index + 1) * OFFSET.size)
+        return self.codec.decode(self._data[start:end])
+
+    def __getitem__(self, item):
+        if self._index is None:
+            raise ValueError('Spilled result is closed.')
+        if isinstance(item, slice):
+            rows = [self._raw(i) for i in range(*item.indices(self._length))]
+            return decode_rows(self.plan, rows, self.db, self.options)
+
+        if item < 0:
+            item += self._length
+        if not 0 <= item < self._length:
+            raise IndexError('Spilled result index out of range')
+        return decode_rows(self.plan, [self._raw(item)], self.db, self.options)[0]
+
+    def __iter__(self):
+        # Decoded a chunk at a time
+        for start in range(0, self._length, self.chunk_size):
+            for obj in self[start:start + self.chunk_size]:
+                yield obj
+
+    def close(self):
+        """
+        Unmap and remove the temporary file.
+        """
+        for mapped in (self._data, self._index):
+            if mapped is not None:
+                mapped.close()
+        for f in self._files:
+            f.close()
+        self._data = self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def spill_rows(queryset, field_names, directory=None, chunk_size=None):
+    """
+    Execute the group_by queryset writing its raw rows to a temporary file,
+    a chunk at a time, and get them as a SpilledResult.
+    """
+    query = queryset.query
+    options = get_options(query)
+    chunk_size = chunk_size or GET_ITERATOR_CHUNK_SIZE
+    plan = RowPlan.for_query(queryset.model, query, field_names)
+    codec = RowCodec(column_typecodes(queryset, plan.names))
+
+    # Raw rows as they are decoded (without related instances to hydrate)
+    raw = queryset._clone()
+    set_options(raw.query, {'row_factory': tuple_rows, 'hydrate': None,
+                            'chunk_size': chunk_size})
+    rows = raw.iterator()
+
+    # Encoded rows in the data file, their offsets in the index file
+    data = tempfile.TemporaryFile(dir=directory)
+    index = tempfile.TemporaryFile(dir=directory)
+    index.write(OFFSET.pack(0))
+    offset = length = 0
+    while True:
+        chunk = [codec.encode(row) for row in islice(rows, chunk_size)]
+        if not chunk:
+            break
+        offsets = []
+        for encoded in chunk:
+            offset += len(encoded)
+            offsets.append(OFFSET.pack(offset))
+        data.write(b''.join(chunk))
+        index.write(b''.join(offsets))
+        length += len(chunk)
+    data.flush()
+    index.flush()
+    return SpilledResult(plan, codec, queryset.db, options, data, index, length, chunk_size)
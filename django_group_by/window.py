@@ -0,0 +1,210 @@
+"""
+This module contains the top-N per group and rollup modes, which wrap the
+compiled group_by query in a window function or a union of its grouping
+levels, so that they take a single query.
+"""
+import sqlite3
+from itertools import islice
+
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+from django.utils import six
+
+try:
+    # Django 1.11+
+    from django.core.exceptions import EmptyResultSet
+
+except ImportError:
+    # Django 1.10-
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+from .fetch import _cursor_chunks
+from .options import get_options
+from .plan import ROLLUP_LEVEL, query_names
+
+# Column with the rank of each row in its top-N partition
+RANK = 'group_by_rank'
+
+
+def supports_window_functions(connection):
+    """
+    Whether the database supports ROW_NUMBER() OVER (PARTITION BY ...).
+    """
+    if connection.vendor in ('postgresql', 'oracle'):
+        return True
+    if connection.vendor == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 25)
+    if connection.vendor == 'mysql':
+        return getattr(connection, 'mysql_version', (0,)) >= (8, 0)
+    return False
+
+
+def aliased_sql(compiler):
+    """
+    Compile the query with an alias for every column, returning the SQL, its
+    params and the aliases in select order (ready to use in SQL).
+    """
+    sql, params = compiler.as_sql(with_col_aliases=True)
+    quote = compiler.connection.ops.quote_name
+    aliases = []
+    col_idx = 1
+    for _, _, alias in compiler.select:
+        if alias:
+            aliases.append(quote(alias))
+        else:
+            # Same as in the compiler
+            aliases.append('Col%d' % col_idx)
+            col_idx += 1
+    return sql, params, aliases
+
+
+def execute_rows(compiler, sql, params):
+    """
+    Execute the SQL, whose first columns are those of the compiled query,
+    and iterate its rows with the compiler's converters applied.
+    """
+    cursor = compiler.connection.cursor()
+    cursor.execute(sql, params)
+    chunks = _cursor_chunks(cursor, GET_ITERATOR_CHUNK_SIZE, len(compiler.select))
+    return compiler.results_iter(chunks)
+
+
+def _grouped(queryset):
+    # Clone of the grouped queryset without ordering nor limits
+    clone = queryset._clone()
+    clone.query.clear_ordering(force_empty=True)
+    clone.query.clear_limits()
+    return clone
+
+
+def _order_item(ordering, names, aliases, prefix=''):
+    """
+    Get the SQL of the ordering by a selected name ('-' for descending).
+    """
+    name = ordering.lstrip('-')
+    if name not in names:
+        raise ValueError("Can't order by {!r}, only by selected names.".format(ordering))
+    alias = prefix + aliases[names.index(name)]
+    return '{} DESC'.format(alias) if ordering.startswith('-') else '{} ASC'.format(alias)
+
+
+def top_n_rows(queryset, field_names, n, order_by, per):
+    """
+    Get the raw rows of the first n groups by order_by, per distinct values
+    of the per fields, ordered by them and then by rank.
+    """
+    if get_options(queryset.query)['rollup']:
+        raise ValueError("Can't rank queries with subtotals.")
+    names, _ = query_names(queryset.query, field_names)
+    if isinstance(order_by, six.string_types):
+        order_by = [order_by]
+    for name in per:
+        if name not in names:
+            raise ValueError("Can't partition by {!r}, only by grouped names.".format(name))
+
+    grouped = _grouped(queryset)
+    compiler = grouped.query.get_compiler(queryset.db)
+
+    if not supports_window_functions(compiler.connection):
+        # Emulated: ordered by partition and rank, keeping the first n
+        rows = grouped.order_by(*(list(per) + list(order_by)))
+        indexes = [names.index(name) for name in per]
+        compiler = rows.query.get_compiler(queryset.db)
+        result = []
+        partition, count = None, 0
+        for row in compiler.results_iter():
+            key = tuple(row[i] for i in indexes)
+            if key != partition:
+                partition, count = key, 0
+            count += 1
+            if count <= n:
+                result.append(tuple(row[:len(names)]))
+        return result
+
+    try:
+        sql, params, aliases = aliased_sql(compiler)
+    except EmptyResultSet:
+        return []
+    partition = ', '.join('g.' + aliases[names.index(name)] for name in per)
+    ordering = ', '.join(_order_item(o, names, aliases, 'g.') for o in order_by)
+    outer = ', '.join('r.' + aliases[names.index(name)] for name in per)
+    sql = ('SELECT * FROM (SELECT g.*, ROW_NUMBER() OVER (PARTITION BY {partition} '
+           'ORDER BY {ordering}) AS {rank} FROM ({sql}) g) r '
+           'WHERE r.{rank} <= %s ORDER BY {outer}, r.{rank}').format(
+        partition=partition, ordering=ordering, rank=RANK, sql=sql, outer=outer)
+    return list(execute_rows(compiler, sql, list(params) + [n]))
+
+
+def _level_query(query, columns):
+    """
+    Clone the grouped query selecting (and grouping by) only the columns.
+    """
+    level = query.clone()
+    level.clear_ordering(force_empty=True)
+    level.clear_limits()
+    level.clear_select_fields()
+    if columns:
+        level.add_fields(columns, True)
+    if hasattr(level, 'values_select'):
+        # Django 1.9+
+        level.values_select = tuple(columns)
+    level.set_group_by()
+    return level
+
+
+def rollup_rows(queryset, field_names, levels):
+    """
+    Iterate the raw rows of the query and its subtotals per level: for each
+    prefix of the grouped fields (levels has the columns of every field),
+    down to the grand total. The last column is the level of the row.
+
+    Rows are ordered by the grouped fields, with subtotals after the rows
+    they aggregate, and the query's slice applies to all of them.
+    """
+    query = queryset.query
+    if query.extra_select:
+        raise ValueError("Can't compute subtotals of queries with extra selects.")
+    if query.order_by:
+        raise ValueError("Can't order queries with subtotals, they are ordered by the grouped fields.")
+    names, _ = query_names(query, field_names)
+    annotation_names = list(query.annotation_select)
+    db = queryset.db
+
+    # One select per level, every column aliased to its position
+    selects = []
+    params = []
+    for level in range(len(levels), -1, -1):
+        columns = [c for field in levels[:level] for c in field]
+        level_compiler = _level_query(query, columns).get_compiler(db)
+        try:
+            sql, level_params, aliases = aliased_sql(level_compiler)
+        except EmptyResultSet:
+            continue
+        selected = columns + annotation_names
+        outer = []
+        for position, name in enumerate(names):
+            value = aliases[selected.index(name)] if name in selected else 'NULL'
+            outer.append('{} AS c{}'.format(value, position))
+        outer.append('{} AS {}'.format(level, ROLLUP_LEVEL))
+        selects.append('SELECT {} FROM ({}) g{}'.format(', '.join(outer), sql, level))
+        params.extend(level_params)
+    if not selects:
+        return iter([])
+
+    # Subtotals after the rows with the same values of the previous fields
+    ordering = []
+    for level, columns in enumerate(levels, 1):
+        ordering.append('CASE WHEN {} < {} THEN 1 ELSE 0 END'.format(ROLLUP_LEVEL, level))
+        ordering.extend('c{}'.format(names.index(column)) for column in columns)
+    sql = 'SELECT * FROM ({}) u ORDER BY {}'.format(
+        ' UNION ALL '.join(selects), ', '.join(ordering) or ROLLUP_LEVEL)
+
+    # Converters of the grouped query (same columns), the level is kept as it is
+    compiler = _grouped(queryset).query.get_compiler(db)
+    compiler.as_sql()
+    cursor = compiler.connection.cursor()
+    cursor.execute(sql, params)
+    rows = compiler.results_iter(_cursor_chunks(cursor, GET_ITERATOR_CHUNK_SIZE, None))
+    if query.low_mark or query.high_mark is not None:
+        # Sliced, over the rows with subtotals
+        rows = islice(rows, query.low_mark, query.high_mark)
+    return rows
@@ -1,39 +1,99 @@
 
+import json
+import logging
+import pickle
+from array import array
+import sys
+import time
+from datetime import datetime, timedelta
+from unittest import skipIf
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
 try:
     from unittest.mock import patch, MagicMock
 except ImportError:
     from mock import patch, MagicMock
 
-from django.test import TestCase
-from django_group_by import GroupByMixin
+import django
+from django.core.cache import caches
+from django.db import connection
+from django.db.models import Avg, Count, Max, Min, Sum
+from django.db.models.query import QuerySet
+from django.test import TestCase, TransactionTestCase
+from django.utils import six, timezone
+from django_group_by import (GroupByMixin, dict_rows, group_by_batch, namedtuple_rows, tuple_rows,
+                             warm_group_by_cache)
+from django_group_by import hydrate
+from django_group_by.cache import LRUCache, TTLCache, clear_caches, fields_cache, plan_cache
 from django_group_by.group import AggregatedGroup
+from django_group_by.materialized import materialized, register, unregister
+from django_group_by.models import GroupSummary
+from django_group_by.parallel import partition_bounds
+from django_group_by.keyset import key_columns
+from django_group_by.instrument import LoggingAdapter, MetricsRegistry, query_executed
+from django_group_by.plan import RelatedTarget, RowPlan
+from django_group_by.results import generations
+from django_group_by.spill import RowCodec
 
 from .models import Book, Author, Genre, Nation
-from .factories import AuthorFactory, BookFactory, GenreFactory
+from .factories import AuthorFactory, BookFactory, GenreFactory, NationalityFactory
 
 
 class AggregatedGroupTest(TestCase):
 
-    @patch.object(AggregatedGroup, '_set_values', MagicMock())
     def test_data(self):
         # Simplest case, no nesting
         agg = AggregatedGroup(None, {'name': 'Peter', 'age': 56})
-        self.assertEqual(agg._data, {'name': 'Peter', 'age': 56})
+        self.assertEqual((agg.name, agg.age), ('Peter', 56))
 
         # First level nesting
         agg = AggregatedGroup(None, {'name': 'Peter', 'friend__age': 56})
-        self.assertEqual(agg._data, {'name': 'Peter', 'friend': {'age': 56}})
+        self.assertEqual((agg.name, agg.friend), ('Peter', {'age': 56}))
 
         # Deep nesting
         agg = AggregatedGroup(None, {'name': 'Peter',
                                      'birth__city__name': 'Akropolis',
                                      'birth__city__foundation__year': 1})
-        self.assertEqual(agg._data, {
+        self.assertEqual(dict((a, getattr(agg, a)) for a in agg._attrs), {
             'name': 'Peter',
             'birth__city': {'name': 'Akropolis'},
             'birth__city__foundation': {'year': 1}
         })
 
+    def test_shape(self):
+        # Class per shape, cached, holding values in slots only
+        shape = AggregatedGroup.shape(Book, ('title', 'author'))
+        self.assertIs(AggregatedGroup.shape(Book, ['title', 'author']), shape)
+        self.assertTrue(issubclass(shape, AggregatedGroup))
+        self.assertEqual(shape.__slots__, ('title', 'author'))
+        agg = shape._make(('Mort', None))
+        self.assertFalse(hasattr(agg, '__dict__'))
+        self.assertEqual(agg.title, 'Mort')
+        self.assertEqual(agg.author, None)
+        self.assertEqual(repr(agg), '<AggregatedGroup for Book>')
+
+        # Names that can't be slots are still set (in a dict)
+        shape = AggregatedGroup.shape(Book, ('title', 'my count', '_make'))
+        self.assertEqual(shape.__slots__, ('title', '__dict__'))
+        agg = shape._make(('Mort', 2, 3))
+        self.assertEqual(getattr(agg, 'my count'), 2)
+        self.assertEqual(agg._make, 3)
+
+    def test_pickle(self):
+        values = {'title': 'Mort', 'author__name': 'Terry Pratchett'}
+        agg = pickle.loads(pickle.dumps(AggregatedGroup(Book, values)))
+        self.assertEqual(agg.title, 'Mort')
+        self.assertEqual(agg.author.name, 'Terry Pratchett')
+
     def test_init(self):
         # Provide only title, has only that attr
         values = {'title': 'The Colour of Magic'}
@@ -51,24 +111,206 @@ class AggregatedGroupTest(TestCase):
         agg = AggregatedGroup(Book, values)
         self.assertEqual(agg.author, None)
 
-        # Change to FK values, without ID
+        # Change to FK values, without ID (instances of deferred subclasses
+        # before Django 1.10, since other fields are deferred)
         values.pop('author__id')
         values.update({'author__name': 'Terry Pratchett', 'genres__name': 'Fantasy'})
         agg = AggregatedGroup(Book, values)
-        self.assertEqual(type(agg.author), Author)
+        self.assertIsInstance(agg.author, Author)
         self.assertEqual(agg.author.name, 'Terry Pratchett')
-        self.assertEqual(type(agg.genres), Genre)
+        self.assertIsInstance(agg.genres, Genre)
         self.assertEqual(agg.genres.name, 'Fantasy')
 
         # Deep relations, make sure it's followed properly
         values.update({'author__nationality__name': 'Great Britain',
                        'author__nationality__demonym': 'British'})
         agg = AggregatedGroup(Book, values)
-        self.assertEqual(type(agg.author_nationality), Nation)
+        self.assertIsInstance(agg.author_nationality, Nation)
         self.assertEqual(agg.author_nationality.name, 'Great Britain')
         self.assertEqual(agg.author_nationality.demonym, 'British')
 
 
+class CacheTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+
+    def test_lru(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+
+        # Full, 'b' was least recently used so it's evicted
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_ttl(self):
+        cache = TTLCache(ttl=60)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+
+        # Expired entries are gone
+        cache.ttl = 0
+        cache.set('b', 2)
+        self.assertEqual(cache.get('b', 3), 3)
+        self.assertEqual(len(cache), 1)
+        cache.clear()
+        self.assertEqual(cache.get('a'), None)
+
+    def test_expansion_cached(self):
+        # Expanded only once for the same model and fields
+        expand = MagicMock(return_value=['author__id', 'author__name'])
+        with patch.object(GroupByMixin, '_expand_group_by_fields', expand):
+            fields = Book.objects.group_by('author')._fields
+            Book.objects.group_by('author')._fields
+        self.assertEqual(tuple(fields), ('author__id', 'author__name'))
+        expand.assert_called_once_with(Book, ('author',), None)
+
+        # Row plans are shared too
+        plan = RowPlan.get(Book, ['title'])
+        self.assertIs(RowPlan.get(Book, ('title',)), plan)
+
+    def test_cleared_on_registry_change(self):
+        GroupByMixin._get_group_by_fields(Book, ('author',))
+        RowPlan.get(Book, ['title'])
+        self.assertEqual(len(fields_cache), 1)
+        self.assertEqual(len(plan_cache), 1)
+
+        # Preparing a new model class clears everything
+        from django.db.models.signals import class_prepared
+        class_prepared.send(sender=Book)
+        self.assertEqual(len(fields_cache), 0)
+        self.assertEqual(len(plan_cache), 0)
+
+    def test_warm(self):
+        warm_group_by_cache([(Book, ('title', 'author')),
+                             ('test_app.Author', ('name',))])
+        self.assertIn((Book, ('title', 'author'), None), fields_cache)
+        self.assertIn((Author, ('name',), None), fields_cache)
+        self.assertIn((Book, ('title', 'author__id', 'author__name',
+                              'author__nationality_id'), (), False), plan_cache)
+
+
+class RowPlanTest(TestCase):
+
+    def test_compile(self):
+        # Own fields and annotations map directly to their column index
+        plan = RowPlan(Book, ['title', 'author__name', 'author__id', 'id__count'],
+                       ['id__count'])
+        self.assertEqual(plan.own, [('title', 0), ('id__count', 3)])
+        self.assertEqual(plan.nested, [])
+
+        # Related fields map to a target with the model class and indexes
+        target, = plan.related
+        self.assertEqual(target.attr, 'author')
+        self.assertEqual(target.model, Author)
+        self.assertEqual(target.field_names, ('name', 'id'))
+        self.assertEqual(target.indexes, (1, 2))
+        self.assertEqual(target.pk_position, 1)
+
+        # Deep relations are resolved to the final model
+        plan = RowPlan(Book, ['author__nationality__name'])
+        target, intermediate = plan.related
+        self.assertEqual(target.attr, 'author_nationality')
+        self.assertEqual(intermediate.attr, 'author')
+        self.assertEqual(target.model, Nation)
+        self.assertEqual(target.pk_position, None)
+
+        # Paths that don't lead to models are kept as dicts
+        plan = RowPlan(Book, ['title__lower', 'title'])
+        self.assertEqual(plan.nested, [('title', ('lower',), (0,))])
+
+    def test_decode(self):
+        plan = RowPlan(Book, ['title', 'author__id', 'author__name', 'genres__name'])
+
+        # Values are set by index, related instances are built
+        agg = plan.decode(('Mort', 3, 'Terry Pratchett', 'Fantasy'))
+        self.assertEqual(agg.title, 'Mort')
+        self.assertIsInstance(agg.author, Author)
+        self.assertEqual(agg.author.id, 3)
+        self.assertEqual(agg.author.name, 'Terry Pratchett')
+        self.assertIsInstance(agg.genres, Genre)
+        self.assertEqual(agg.genres.name, 'Fantasy')
+        self.assertEqual(repr(agg), '<AggregatedGroup for Book>')
+
+        # FK None (ID is None), should not init model
+        agg = plan.decode(('Mort', None, None, 'Fantasy'))
+        self.assertEqual(agg.author, None)
+
+    def test_from_db(self):
+        nation = Nation.objects.create(name='Great Britain', demonym='British')
+
+        # Instances built like loaded from the db (with db state)
+        plan = RowPlan(Book, ['author__nationality_id', 'author__name', 'author__id'])
+        agg = plan.decoder('default')((nation.id, 'Terry Pratchett', 3))
+        self.assertEqual(agg.author.id, 3)
+        self.assertEqual(agg.author.name, 'Terry Pratchett')
+        self.assertEqual(agg.author.nationality_id, nation.id)
+        self.assertFalse(agg.author._state.adding)
+        self.assertEqual(agg.author._state.db, 'default')
+
+        # Columns not grouped by are deferred, loaded from db on access
+        plan = RowPlan(Book, ['author__nationality__id', 'author__nationality__name'])
+        agg = plan.decoder('default')((nation.id, 'Great Britain'))
+        self.assertEqual(agg.author_nationality.get_deferred_fields(), {'demonym'})
+        self.assertEqual(agg.author_nationality.demonym, 'British')
+
+    def test_nested(self):
+        names = ['author__id', 'author__nationality__id', 'author__nationality__name']
+        plan = RowPlan(Book, names)
+        author, nation = sorted(plan.related, key=lambda t: t.attr)
+        link, = plan.links
+        self.assertEqual(link[:2], (plan.related.index(author), plan.related.index(nation)))
+
+        # Nested instance linked to its parent, with no queries
+        with self.assertNumQueries(0):
+            agg = plan.decode((3, 1, 'Great Britain'))
+            self.assertEqual(agg.author.nationality.name, 'Great Britain')
+            self.assertIs(agg.author.nationality, agg.author_nationality)
+
+            # Also None, if the nested FK is None
+            agg = plan.decode((3, None, None))
+            self.assertIsNone(agg.author.nationality)
+            self.assertIsNone(agg.author_nationality)
+
+        # Lazy instances are linked when built, and built once
+        plan = RowPlan(Book, names, lazy_related=True)
+        agg = plan.decode((3, 1, 'Great Britain'))
+        self.assertIs(agg.author.nationality, agg.author_nationality)
+        agg = plan.decode((3, 1, 'Great Britain'))
+        self.assertIs(agg.author_nationality, agg.author.nationality)
+
+    def test_intermediate(self):
+        # Path not grouped by, built without pk to link the nested instance
+        plan = RowPlan(Book, ['author__nationality__id', 'author__nationality__name'])
+        with self.assertNumQueries(0):
+            agg = plan.decode((1, 'Great Britain'))
+            self.assertIsNone(agg.author.pk)
+            self.assertEqual(agg.author.nationality_id, 1)
+            self.assertEqual(agg.author.nationality.name, 'Great Britain')
+            self.assertIs(agg.author.nationality, agg.author_nationality)
+            agg = plan.decode((None, None))
+            self.assertIsNone(agg.author.nationality_id)
+            self.assertIsNone(agg.author.nationality)
+
+        # Also lazily, built once
+        plan = RowPlan(Book, ['author__nationality__id'], lazy_related=True)
+        agg = plan.decode((1,))
+        self.assertIs(agg.author.nationality, agg.author_nationality)
+        self.assertIs(agg.author, agg.author)
+
+        # Not through many to many fields
+        plan = RowPlan(Book, ['genres__name'])
+        self.assertEqual([t.attr for t in plan.related], ['genres'])
+
+
 class QuerySetTest(TestCase):
 
     def test_expand_group_by_field(self):
@@ -91,6 +333,531 @@ class QuerySetTest(TestCase):
                                        'author__nationality__id', 'author__nationality__name',
                                        'author__nationality__demonym', 'genres__id', 'genres__name'})
 
+    def test_expand_group_by_field_only(self):
+        # FK grouped by primary key only
+        fields = GroupByMixin._expand_group_by_fields(Book, ['title', 'author'], only=())
+        self.assertEqual(fields, ['title', 'author__id'])
+
+        # Plus the selected related fields, also for deeper relations
+        fields = GroupByMixin._expand_group_by_fields(
+            Book, ['author', 'author__nationality'], only=['author__name'])
+        self.assertEqual(set(fields), {'author__id', 'author__name', 'author__nationality__id'})
+
+        # Selected fields can bring their own FKs (pruned too)
+        fields = GroupByMixin._expand_group_by_fields(Book, ['title'], only=['author__nationality'])
+        self.assertEqual(set(fields), {'title', 'author__nationality__id'})
+
+    def test_group_by_only(self):
+        author = AuthorFactory.create(name='Terry Pratchett', nationality__name='Great Britain')
+        BookFactory.create(author=author, title='Mort')
+
+        # Smaller GROUP BY, and no join at all without related fields
+        def group_by_sql(qs):
+            sql, _ = qs.query.get_compiler('default').as_sql()
+            return sql.split(' GROUP BY ')[1]
+
+        full = Book.objects.group_by('author').annotate(Count('id'))
+        some = Book.objects.group_by('author', only=['author__name']).annotate(Count('id'))
+        pks = Book.objects.group_by('author', only=()).annotate(Count('id'))
+        self.assertEqual(group_by_sql(full).count(', '), 2)
+        self.assertEqual(group_by_sql(some).count(', '), 1)
+        self.assertEqual(group_by_sql(pks), '"test_app_book"."author_id"')
+        self.assertNotIn('JOIN', str(pks.query))
+
+        # Which lets the database aggregate on the FK index (SQLite plan)
+        if connection.vendor == 'sqlite':
+            def query_plan(qs):
+                sql, params = qs.query.get_compiler('default').as_sql()
+                with connection.cursor() as cursor:
+                    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                    return ' '.join(str(row[-1]) for row in cursor.fetchall())
+            self.assertIn('TEMP B-TREE FOR GROUP BY', query_plan(full))
+            self.assertNotIn('TEMP B-TREE FOR GROUP BY', query_plan(pks))
+
+        # Related instances have the other fields deferred
+        row, = some
+        self.assertEqual(row.author, author)
+        self.assertEqual(row.author.name, 'Terry Pratchett')
+        self.assertEqual(row.author.get_deferred_fields(), {'nationality_id'})
+        self.assertEqual(row.id__count, 1)
+        row, = pks
+        self.assertEqual(row.author.get_deferred_fields(), {'name', 'nationality_id'})
+        with self.assertNumQueries(1):
+            self.assertEqual(row.author.name, 'Terry Pratchett')
+
+    def test_group_by_nested_only(self):
+        nation = NationalityFactory.create(name='Great Britain')
+        AuthorFactory.create(name='Terry Pratchett', nationality=nation)
+        AuthorFactory.create(name='Neil Gaiman', nationality=nation)
+        for author in Author.objects.all():
+            BookFactory.create(author=author)
+
+        # Grouped by nationality alone, still reachable through the author
+        row, = Book.objects.group_by('author__nationality__name').annotate(Count('id'))
+        self.assertEqual(row.author.nationality.name, 'Great Britain')
+        self.assertEqual(row.id__count, 2)
+
+    def test_hydrate_batch(self):
+        nation = NationalityFactory.create(name='Great Britain')
+        terry = AuthorFactory.create(name='Terry Pratchett', nationality=nation)
+        neil = AuthorFactory.create(name='Neil Gaiman', nationality=nation)
+        nobody = AuthorFactory.create(name='Nobody', nationality=None)
+        BookFactory.create_batch(2, author=terry)
+        BookFactory.create(author=neil)
+        BookFactory.create(author=nobody)
+
+        # Grouped by FK only, then one query per related model
+        qs = Book.objects.group_by('author', 'author__nationality', hydrate='batch')
+        qs = qs.annotate(Count('id')).order_by('author__id')
+        self.assertNotIn('test_app_nation', str(qs.query))
+        with self.assertNumQueries(3):
+            rows = list(qs)
+            self.assertEqual([r.author.name for r in rows],
+                             ['Terry Pratchett', 'Neil Gaiman', 'Nobody'])
+            self.assertEqual([r.id__count for r in rows], [2, 1, 1])
+
+        # Fully loaded and shared, None FK kept as None
+        self.assertEqual(rows[0].author.get_deferred_fields(), set())
+        self.assertEqual(rows[0].author_nationality.demonym, nation.demonym)
+        self.assertIs(rows[0].author_nationality, rows[1].author_nationality)
+        self.assertIsNone(rows[2].author_nationality)
+
+        # In chunks while streaming, fetching only missing instances
+        qs = Book.objects.group_by('author', hydrate='batch', chunk_size=2)
+        with self.assertNumQueries(3):
+            rows = list(qs.annotate(Count('id')).order_by('author__id').iterator())
+        self.assertEqual([r.author for r in rows], [terry, neil, nobody])
+
+        # Nothing fetched for plain rows
+        qs = Book.objects.group_by('author', hydrate='batch', row_factory=tuple_rows)
+        with self.assertNumQueries(1):
+            rows = list(qs.annotate(Count('id')).order_by('author__id'))
+        self.assertEqual(rows, [(terry.id, 2), (neil.id, 1), (nobody.id, 1)])
+
+        # Only valid modes
+        self.assertRaises(ValueError, Book.objects.group_by, 'author', hydrate='join')
+
+    def test_hydrate_dimensions(self):
+        # Dimension tables of other tests may be cached (same pks)
+        clear_caches()
+        nation = NationalityFactory.create(name='Great Britain')
+        terry = AuthorFactory.create(name='Terry Pratchett', nationality=nation)
+        nobody = AuthorFactory.create(name='Nobody', nationality=None)
+        BookFactory.create_batch(2, author=terry)
+        BookFactory.create(author=nobody)
+
+        # Small table: aggregated by FK column, nations from the cached table
+        # (counted and loaded when first evaluated)
+        with self.assertNumQueries(0):
+            qs = Book.objects.group_by('author__nationality', hydrate='auto')
+        self.assertEqual(qs._group_by_field_names(), ['author__nationality__id'])
+        qs = qs.annotate(Count('id')).order_by('author__nationality__id')
+        with self.assertNumQueries(3):
+            rows = list(qs)
+        with self.assertNumQueries(1):
+            rows = list(qs.all())
+            self.assertEqual([(r.author_nationality, r.id__count) for r in rows],
+                             [(None, 1), (nation, 2)])
+            self.assertEqual(rows[1].author_nationality.demonym, nation.demonym)
+
+        # Every execution has its own instances
+        rows[1].author_nationality.name = 'Changed'
+        self.assertEqual(list(qs.all())[1].author_nationality.name, 'Great Britain')
+
+        # Saving (or deleting) a row evicts the table and size, loaded again
+        nation.demonym = 'Brit'
+        nation.save()
+        with self.assertNumQueries(3):
+            self.assertEqual(list(qs.all())[1].author_nationality.demonym, 'Brit')
+
+        # Rows added without signals (or by other processes) are fetched,
+        # until the table is loaded again
+        Nation.objects.bulk_create([Nation(name='Ireland', demonym='Irish')])
+        other = Nation.objects.get(name='Ireland')
+        BookFactory.create(author=AuthorFactory.create(name='Someone', nationality=other))
+        with self.assertNumQueries(2):
+            self.assertEqual(list(qs.all())[-1].author_nationality.name, 'Ireland')
+
+        # Bigger tables are fetched in batches, unless forced
+        joined = Book.objects.group_by('author', hydrate='auto').annotate(Count('id'))
+        forced = Book.objects.group_by('author', hydrate='dimensions').annotate(Count('id'))
+        self.assertEqual(forced._group_by_field_names(), ['author__id'])
+        with patch('django_group_by.dimensions.MAX_ROWS', 1):
+            with self.assertNumQueries(3):
+                rows = list(joined.order_by('author__id'))
+            self.assertEqual([(r.author.name, r.id__count) for r in rows],
+                             [('Terry Pratchett', 2), ('Nobody', 1), ('Someone', 1)])
+            with self.assertNumQueries(2):
+                list(joined.all())
+            with self.assertNumQueries(2):
+                rows = list(forced.order_by('author__id'))
+            self.assertEqual([(r.author.name, r.id__count) for r in rows],
+                             [('Terry Pratchett', 2), ('Nobody', 1), ('Someone', 1)])
+
+    def test_export(self):
+        author = AuthorFactory.create(name=u'Terry Pratchett', nationality=None)
+        BookFactory.create(author=author, title=u'Mort, the "Apprentice"',
+                           publication_date=datetime(1987, 11, 12))
+        BookFactory.create(author=author, title=u'Eric \u00e9',
+                           publication_date=datetime(1990, 8, 1))
+        qs = Book.objects.group_by('title', 'author').annotate(Count('id')).order_by('-title')
+
+        # CSV with expanded names as header, written to a stream
+        stream = six.BytesIO() if six.PY2 else six.StringIO()
+        with patch.object(AggregatedGroup, '_make') as make:
+            self.assertIsNone(qs.export('csv', stream))
+            self.assertFalse(make.called)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(lines[0].split(','), ['title', 'author__id', 'author__name',
+                                               'author__nationality_id', 'id__count'])
+        expected = u'"Mort, the ""Apprentice""",{},Terry Pratchett,,1'.format(author.id)
+        self.assertEqual(lines[1], expected.encode('utf-8') if six.PY2 else expected)
+        self.assertEqual(len(lines), 3)
+
+        # JSON Lines as a generator of chunks
+        chunks = list(qs.export('jsonl', chunk_size=1))
+        self.assertEqual(len(chunks), 2)
+        rows = [json.loads(line) for chunk in chunks for line in chunk.splitlines()]
+        self.assertEqual([r['title'] for r in rows], [u'Mort, the "Apprentice"', u'Eric \u00e9'])
+        self.assertEqual(rows[1]['author__nationality_id'], None)
+        self.assertEqual(rows[1]['id__count'], 1)
+        self.assertTrue(chunks[0].startswith('{"title": '))
+
+        # With subtotals and their level
+        rollup = Book.objects.group_by('title', rollup=True).annotate(Count('id'))
+        lines = ''.join(rollup.export('csv')).splitlines()
+        self.assertEqual(lines[0], 'title,id__count,rollup_level')
+        self.assertEqual(lines[-1], ',2,0')
+        self.assertEqual(len(lines), 4)
+
+        # Only for group_by querysets, and known formats
+        self.assertRaises(TypeError, Book.objects.all().export)
+        self.assertRaises(ValueError, qs.export, 'xml')
+
+    def test_parallel(self):
+        terry = AuthorFactory.create(name='Terry Pratchett')
+        neil = AuthorFactory.create(name='Neil Gaiman')
+        for year, author in enumerate([terry] * 5 + [neil] * 3 + [terry] * 4, 1980):
+            BookFactory.create(author=author, publication_date=datetime(year, 1, 1))
+        qs = Book.objects.group_by('author').annotate(
+            books=Count('id'), first=Min('publication_date'), last=Max('publication_date'),
+            total=Sum('id'), mean=Avg('id')).order_by('-books')
+
+        # Same rows as a single query, merged from partial aggregates
+        expected = [(r.author, r.books, r.first, r.last, r.total, r.mean) for r in qs]
+        for partition_by, bounds in (('publication_date', None), ('id', None),
+                                     ('publication_date', (datetime(1900, 1, 1), datetime(2100, 1, 1)))):
+            rows = qs.parallel(partition_by, workers=1, bounds=bounds, partitions=3)
+            self.assertEqual([(r.author, r.books, r.first, r.last, r.total, r.mean) for r in rows],
+                             expected)
+        self.assertEqual(rows[0].author.name, 'Terry Pratchett')
+
+        # Partial queries split by range
+        with self.assertNumQueries(4):
+            qs.parallel('id', workers=1, bounds=(1, 100), partitions=3)
+        lookups = partition_bounds(qs, 'id', 3, (1, 100))
+        self.assertEqual(lookups, [{'id__lt': 34}, {'id__gte': 34, 'id__lt': 67},
+                                   {'id__gte': 67}, {'id__isnull': True}])
+
+        # Ungrouped values are just put together, limits applied after sorting
+        rows = Book.objects.group_by('title', 'publication_date').order_by('-title')[:2]
+        self.assertEqual([r.title for r in rows.parallel('publication_date', 1, partitions=2)],
+                         [r.title for r in rows])
+        rows = Book.objects.group_by('title').order_by('publication_date')
+        self.assertRaises(ValueError, rows.parallel, 'id', 1)
+
+        # Only decomposable aggregates, and not filtered by them
+        res = Book.objects.group_by('author').annotate(Count('id', distinct=True))
+        self.assertRaises(ValueError, res.parallel, 'id', 1)
+        res = Book.objects.group_by('author').annotate(books=Count('id')).filter(books__gt=1)
+        self.assertRaises(ValueError, res.parallel, 'id', 1)
+        self.assertRaises(ValueError, qs.parallel, 'author__name', 1, partitions=2)
+
+        # Subtotals can't be merged
+        res = Book.objects.group_by('author', rollup=True).annotate(Count('id'))
+        self.assertRaises(ValueError, res.parallel, 'id', 1)
+
+    def test_top_n(self):
+        terry = AuthorFactory.create(name='Terry Pratchett')
+        neil = AuthorFactory.create(name='Neil Gaiman')
+        for author, title, copies in ((terry, 'Mort', 3), (terry, 'Eric', 1), (terry, 'Sourcery', 2),
+                                      (neil, 'Coraline', 2), (neil, 'Stardust', 1)):
+            BookFactory.create_batch(copies, author=author, title=title)
+        qs = Book.objects.group_by('author', 'title').annotate(copies=Count('id'))
+
+        # First n groups by the order, for every author, in a single query
+        expected = [(terry, 'Mort', 3), (terry, 'Sourcery', 2), (neil, 'Coraline', 2), (neil, 'Stardust', 1)]
+        expected.sort(key=lambda r: r[0].id)
+        with self.assertNumQueries(1):
+            rows = qs.top_n(2, '-copies', per='author')
+        self.assertEqual([(r.author, r.title, r.copies) for r in rows], expected)
+        self.assertEqual(rows[0].author.name, expected[0][0].name)
+
+        # Same when emulated (ordered query), also with pruned FKs
+        qs = Book.objects.group_by('author', 'title', only=()).annotate(copies=Count('id'))
+        with patch('django_group_by.window.supports_window_functions', return_value=False):
+            rows = qs.top_n(2, ['-copies', 'title'], per=['author'])
+        self.assertEqual([(r.author, r.title, r.copies) for r in rows], expected)
+
+        # Only by grouped fields and selected names
+        self.assertRaises(ValueError, qs.top_n, 2, '-copies', per='genres')
+        self.assertRaises(ValueError, qs.top_n, 2, 'publication_date', per='author')
+
+        # Not with subtotals
+        qs = Book.objects.group_by('author', 'title', rollup=True).annotate(copies=Count('id'))
+        self.assertRaises(ValueError, qs.top_n, 2, '-copies', per='author')
+
+    def test_rollup(self):
+        nation = NationalityFactory.create(name='Great Britain')
+        terry = AuthorFactory.create(name='Terry Pratchett', nationality=nation)
+        neil = AuthorFactory.create(name='Neil Gaiman', nationality=nation)
+        nobody = AuthorFactory.create(name='Nobody', nationality=None)
+        for author, copies in ((terry, 3), (neil, 2), (nobody, 1)):
+            BookFactory.create_batch(copies, author=author)
+
+        # Subtotals per nationality after their authors, then the grand total
+        qs = Book.objects.group_by('author__nationality', 'author', rollup=True)
+        qs = qs.annotate(copies=Count('id'), last=Max('id'))
+        with self.assertNumQueries(1):
+            rows = [(r.rollup_level, r.author_nationality, r.author, r.copies) for r in qs]
+        authors = sorted([neil, terry], key=lambda a: a.id)
+        self.assertEqual(rows, [
+            (2, None, nobody, 1), (1, None, None, 1),
+            (2, nation, authors[0], 3 if authors[0] == terry else 2),
+            (2, nation, authors[1], 3 if authors[1] == terry else 2),
+            (1, nation, None, 5),
+            (0, None, None, 6),
+        ])
+        self.assertEqual(list(qs)[-1].last, Book.objects.order_by('-id')[0].id)
+
+        # Sliced over the rows with subtotals, not ordered by other columns
+        self.assertEqual([(r.rollup_level, r.author_nationality, r.author, r.copies) for r in qs.all()[1:3]],
+                         rows[1:3])
+
+        # count() is the number of groups, without subtotals
+        self.assertEqual(qs.all().count(), 3)
+        self.assertRaises(ValueError, list, qs.order_by('-copies'))
+
+        # Filters apply to every level, other row factories get the level too
+        qs = Book.objects.filter(author=terry).group_by('title', rollup=True, row_factory=dict_rows)
+        rows = list(qs.annotate(copies=Count('id')))
+        self.assertEqual(rows[-1], {'title': None, 'copies': 3, 'rollup_level': 0})
+
+    def test_group_by_m2m(self):
+        terry = AuthorFactory.create(name='Terry Pratchett')
+        neil = AuthorFactory.create(name='Neil Gaiman')
+        fantasy = GenreFactory.create(name='Fantasy')
+        comedy = GenreFactory.create(name='Comedy')
+        for book in BookFactory.create_batch(2, author=terry):
+            book.genres.add(fantasy, comedy)
+        BookFactory.create(author=terry).genres.add(fantasy)
+        BookFactory.create(author=neil)
+
+        # Joined, every book is counted once per genre
+        joined = Book.objects.group_by('author').annotate(Count('id')).filter(genres__isnull=False)
+        self.assertEqual([r.id__count for r in joined], [5])
+
+        # Apart, a single row per author with correct counts and the genres
+        qs = Book.objects.group_by('author', 'genres', m2m='batch').annotate(Count('id'))
+        with self.assertNumQueries(2):
+            rows = list(qs.order_by('author'))
+        self.assertEqual([(r.author, r.id__count) for r in rows], [(terry, 3), (neil, 1)])
+        self.assertEqual(rows[0].genres, sorted([fantasy, comedy], key=lambda g: g.id))
+        self.assertEqual(rows[0].genres[0].name, 'Fantasy')
+        self.assertEqual(rows[1].genres, [])
+
+        # Lists of primary keys in columns and exports
+        qs = qs.order_by('author')
+        self.assertEqual(list(qs.columns()['genres']), [sorted([fantasy.id, comedy.id]), []])
+        rows = [json.loads(line) for line in ''.join(qs.export('jsonl')).splitlines()]
+        self.assertEqual([r['genres'] for r in rows], [sorted([fantasy.id, comedy.id]), []])
+        lines = ''.join(qs.export('csv')).splitlines()
+        self.assertEqual(lines[0].split(',')[-1], 'genres')
+        self.assertTrue(lines[2].endswith(',[]'))
+
+        # Also with other row factories, and only by grouped fields
+        rows = list(Book.objects.filter(author=terry)
+                    .group_by('genres', 'title', m2m='batch', row_factory=dict_rows))
+        self.assertEqual(set(len(r['genres']) for r in rows), {1, 2})
+        self.assertRaises(ValueError, Book.objects.group_by, 'genres', m2m='batch')
+        self.assertRaises(ValueError, Book.objects.group_by, 'title', 'genres', m2m='join')
+        self.assertRaises(ValueError, Book.objects.group_by, 'title', 'genres',
+                          m2m='batch', rollup=True)
+        self.assertRaises(ValueError, list, qs.filter(id__count__gt=1))
+
+    def test_group_by_batch(self):
+        terry = AuthorFactory.create(name='Terry Pratchett')
+        BookFactory.create_batch(2, author=terry, title='Mort')
+        BookFactory.create(author=AuthorFactory.create(name='Neil Gaiman'), title='Coraline')
+        by_author = Book.objects.group_by('author').annotate(Count('id')).order_by('author')
+        by_title = Book.objects.group_by('title', row_factory=dict_rows).order_by('title').distinct()
+
+        # Every queryset decoded with its own layout, in order
+        with self.assertNumQueries(2):
+            rows_a, rows_b = group_by_batch([by_author, by_title], workers=1)
+        self.assertIsNone(by_author._result_cache)
+        self.assertEqual([(r.author, r.id__count) for r in rows_a],
+                         [(r.author, r.id__count) for r in by_author])
+        self.assertEqual(rows_b, [{'title': 'Coraline'}, {'title': 'Mort'}])
+
+        # Only group_by querysets
+        self.assertRaises(TypeError, group_by_batch, [by_author, Book.objects.all()])
+
+    def test_spill(self):
+        terry = AuthorFactory.create(name='Terry Pratchett')
+        neil = AuthorFactory.create(name='Neil Gaiman')
+        for i in range(5):
+            BookFactory.create(author=terry if i % 2 else neil, title='Book {}'.format(i % 3))
+        qs = Book.objects.group_by('title', 'author').annotate(Count('id'), Avg('id'))
+        qs = qs.order_by('title', 'author')
+        expected = [(r.title, r.author, r.id__count, r.id__avg) for r in qs]
+
+        # Rows written in chunks, then decoded on access without queries
+        with qs.spill(chunk_size=2) as result:
+            with self.assertNumQueries(0):
+                self.assertEqual(len(result), len(expected))
+                self.assertEqual(result[1].author, expected[1][1])
+                self.assertEqual(result[-1].title, expected[-1][0])
+                self.assertEqual([(r.title, r.id__count) for r in result[::2]],
+                                 [(t, c) for t, _, c, _ in expected[::2]])
+                for _ in range(2):
+                    self.assertEqual([(r.title, r.author, r.id__count, r.id__avg) for r in result],
+                                     expected)
+            self.assertRaises(IndexError, lambda: result[len(expected)])
+        self.assertRaises(ValueError, lambda: result[0])
+
+        # Related instances hydrated per access
+        with Book.objects.group_by('author', hydrate='batch').order_by('author').spill() as result:
+            with self.assertNumQueries(1):
+                self.assertEqual(result[0].author.name, 'Terry Pratchett')
+        with Book.objects.filter(title='Nothing').group_by('title').spill() as result:
+            self.assertEqual(list(result), [])
+
+    def test_spill_codec(self):
+        codec = RowCodec(['q', 'd', None, 'q'])
+        for row in ((1, 1.5, 'a', None), (None, None, None, 2),
+                    (True, 1.5, 'a', 3), (2 ** 70, 1.0, 'b', 4), (1, 2, 'c', 5)):
+            encoded = codec.encode(row)
+            decoded = codec.decode(encoded)
+            self.assertEqual(decoded, row)
+            self.assertEqual([type(v) for v in decoded], [type(v) for v in row])
+
+        # Fixed width if all columns are numeric
+        codec = RowCodec(['q', 'd'])
+        self.assertEqual(len(set(len(codec.encode(r)) for r in ((1, 2.0), (None, 3.0)))), 1)
+
+    def test_page_after(self):
+        nation = NationalityFactory.create(name='Great Britain')
+        for i, name in enumerate(('Terry Pratchett', 'Neil Gaiman', 'Nobody')):
+            author = AuthorFactory.create(name=name, nationality=nation if i < 2 else None)
+            for title in ('Mort', 'Eric', 'Coraline')[i:]:
+                BookFactory.create_batch(2, author=author, title=title)
+        qs = Book.objects.group_by('author__nationality', 'title').annotate(Count('id'))
+        expected = [(r.author_nationality, r.title, r.id__count)
+                    for r in qs.order_by('title', 'author__nationality__id')]
+
+        # Ordered by title and the nationality's pk (NULL first here)
+        self.assertEqual(key_columns(Book, qs._group_by_field_names()),
+                         ['title', 'author__nationality__id'])
+        rows, cursor = [], None
+        while True:
+            with self.assertNumQueries(1):
+                page = qs.page_after(cursor, size=2)
+            rows.extend((r.author_nationality, r.title, r.id__count) for r in page)
+            cursor = page.next_cursor
+            if not page.has_next:
+                break
+        self.assertEqual(rows, expected)
+        self.assertEqual(rows[0][:2], (None, 'Coraline'))
+
+        # Counts of all the pages, exact or estimated (exact here)
+        self.assertEqual(qs.page_after(size=2, count='exact').count, len(expected))
+        self.assertEqual(qs.page_after(size=2, count='estimate').count, len(expected))
+        self.assertEqual(qs.estimated_count(), len(expected))
+
+        # Full precision datetimes in cursors
+        date = datetime(2001, 2, 3, 4, 5, 6, 789012, tzinfo=timezone.utc)
+        Book.objects.update(publication_date=date)
+        Book.objects.filter(title='Mort').update(publication_date=date + timedelta(seconds=1))
+        dates = Book.objects.group_by('publication_date').distinct()
+        page = dates.page_after(size=1)
+        self.assertEqual([r.publication_date for r in dates.page_after(page.next_cursor)],
+                         [date + timedelta(seconds=1)])
+        self.assertRaises(ValueError, dates.page_after, size=0)
+
+        # Cursors only for the same keys, not by many to many fields
+        self.assertRaises(ValueError, qs.page_after, 'nope')
+        cursor = qs.page_after(size=1).next_cursor
+        self.assertRaises(ValueError, Book.objects.group_by('title').page_after, cursor)
+        self.assertRaises(ValueError, Book.objects.group_by('genres').page_after)
+
+        # Many to many lists fetched apart, only for the groups of the page
+        fantasy = GenreFactory.create(name='Fantasy')
+        for book in Book.objects.all():
+            book.genres.add(fantasy)
+        qs = Book.objects.group_by('author', 'title', 'genres', m2m='batch').annotate(Count('id'))
+        with patch.object(RelatedTarget, 'build', autospec=True, side_effect=RelatedTarget.build) as build:
+            with self.assertNumQueries(2):
+                page = qs.page_after(size=2)
+        self.assertEqual([r.genres for r in page], [[fantasy], [fantasy]])
+        built = [args[0].model for args, _ in build.call_args_list]
+        self.assertEqual(built.count(Genre), 3)
+
+    def test_instrumentation(self):
+        author = AuthorFactory.create(name='Terry Pratchett', nationality__name='Great Britain')
+        BookFactory.create_batch(2, author=author)
+        BookFactory.create(author__nationality=None)
+        qs = Book.objects.group_by('author', 'author__nationality').annotate(Count('id'))
+
+        # Nothing measured without receivers
+        with patch('django_group_by.instrument.QueryStats') as stats_class:
+            list(qs.all())
+            self.assertFalse(stats_class.called)
+
+        # Stats sent once per evaluation, by model
+        registry = MetricsRegistry()
+        logger = MagicMock(spec=logging.Logger)
+        query_executed.connect(registry, sender=Book, weak=False)
+        query_executed.connect(LoggingAdapter(logger), weak=False, dispatch_uid='test')
+        try:
+            list(qs.all())
+            list(qs.iterator())
+            list(Author.objects.all())
+        finally:
+            query_executed.disconnect(registry, sender=Book)
+            query_executed.disconnect(dispatch_uid='test')
+
+        metrics = registry.snapshot()['test_app.book']
+        self.assertEqual(metrics['queries'], 2)
+        self.assertEqual(metrics['fields'], 2 * (3 + 3))
+        self.assertEqual(metrics['rows'], 2 * 2)
+        self.assertEqual(metrics['related'], 2 * 3)
+        for name in ('sql_time', 'fetch_time', 'related_time', 'decode_time'):
+            self.assertGreaterEqual(metrics[name], 0)
+        self.assertGreater(metrics['sql_time'], 0)
+        self.assertEqual(logger.log.call_count, 2)
+        self.assertIn('Book', logger.log.call_args[0][1] % logger.log.call_args[0][2:])
+
+        registry.reset()
+        self.assertEqual(registry.snapshot(), {})
+
+        # Follow-up queries of hydration measured apart from the query's
+        fetch_related = hydrate.fetch_related
+
+        def slow_fetch_related(*args):
+            time.sleep(0.05)
+            return fetch_related(*args)
+
+        query_executed.connect(registry, sender=Book, weak=False)
+        try:
+            with patch('django_group_by.hydrate.fetch_related', slow_fetch_related):
+                list(Book.objects.group_by('author', hydrate='batch').annotate(Count('id')))
+        finally:
+            query_executed.disconnect(registry, sender=Book)
+        metrics = registry.snapshot()['test_app.book']
+        self.assertGreaterEqual(metrics['related_time'], 0.05)
+        self.assertLess(metrics['sql_time'] + metrics['fetch_time'], 0.05)
+
     def test_group_by(self):
         # Create two books by same author
         author1 = AuthorFactory.create(name='Terry Pratchett', nationality__name='Great Britain')
@@ -136,7 +903,7 @@ class QuerySetTest(TestCase):
             with self.assertRaises(AttributeError):
                 group.genre
 
-        # Group by nationality, only attr author_nationality is included
+        # Group by nationality, author_nationality (and the author to reach it)
         # Note: invert order because None goes first
         res = Book.objects.group_by('author__nationality').order_by('-author__nationality').distinct()
         self.assertEqual(res.count(), 2)
@@ -145,13 +912,18 @@ class QuerySetTest(TestCase):
         self.assertEqual(tp.author_nationality.name, 'Great Britain')
         with self.assertRaises(AttributeError):
             tp.title
-        with self.assertRaises(AttributeError):
-            tp.author
+        self.assertIs(tp.author.nationality, tp.author_nationality)
         self.assertEqual(oth.author_nationality, None)
         with self.assertRaises(AttributeError):
             oth.title
-        with self.assertRaises(AttributeError):
-            oth.author
+        self.assertIsNone(oth.author.nationality)
+
+        # Group by author and nationality, nationality linked to author too
+        res = Book.objects.group_by('author', 'author__nationality').distinct()
+        with self.assertNumQueries(1):
+            nationalities = dict((r.author, r.author.nationality) for r in res)
+        self.assertEqual(nationalities[author1], author1.nationality)
+        self.assertIsNone(nationalities[author2])
 
         # Group by title+genre, should expand to 5 groups
         res = Book.objects.group_by('title', 'genres').order_by('genres__name', 'title').distinct()
@@ -167,3 +939,398 @@ class QuerySetTest(TestCase):
         self.assertEqual(b4.title, 'The Colour of Magic')
         self.assertEqual(b5.genres, fantasy)
         self.assertEqual(b5.title, 'The Light Fantastic')
+
+    def test_group_by_annotate(self):
+        author = AuthorFactory.create(name='Terry Pratchett')
+        BookFactory.create(author=author, title='Mort')
+        BookFactory.create(author=author, title='Eric')
+
+        # Annotations are own attributes, even with default names
+        res = Book.objects.group_by('author').annotate(Count('id'))
+        row, = res
+        self.assertEqual(row.author, author)
+        self.assertEqual(row.id__count, 2)
+
+    def test_group_by_lazy_related(self):
+        author = AuthorFactory.create(name='Terry Pratchett')
+        BookFactory.create(author=author, title='Mort')
+
+        # Related instance is not built until accessed
+        res = Book.objects.group_by('title', 'author', lazy_related=True).distinct()
+        with patch.object(Author, '__init__', MagicMock(return_value=None)) as init:
+            row, = res
+            self.assertEqual(row.title, 'Mort')
+            init.assert_not_called()
+
+        # Built once on access, option kept after cloning
+        row, = res.order_by('title')
+        self.assertEqual(row.author, author)
+        self.assertIs(row.author, row.author)
+        self.assertEqual(row.author.name, 'Terry Pratchett')
+
+        # Unknown options are rejected
+        with self.assertRaises(TypeError):
+            Book.objects.group_by('title', lazy=True)
+
+    def test_group_by_identity_map(self):
+        author = AuthorFactory.create(name='Terry Pratchett', nationality__name='Great Britain')
+        BookFactory.create(author=author, title='Mort')
+        BookFactory.create(author=author, title='Eric')
+
+        # Without identity map, every row builds its own instances
+        res = Book.objects.group_by('title', 'author', 'author__nationality')
+        row_a, row_b = res
+        self.assertEqual(row_a.author, row_b.author)
+        self.assertIsNot(row_a.author, row_b.author)
+
+        # With it, rows share the related instances by model and pk
+        res = res.group_by('title', 'author', 'author__nationality', identity_map=True)
+        row_a, row_b = res
+        self.assertIs(row_a.author, row_b.author)
+        self.assertIs(row_a.author_nationality, row_b.author_nationality)
+
+        # Also when built lazily, but only within one evaluation
+        res = Book.objects.group_by('title', 'author', identity_map=True, lazy_related=True)
+        row_a, row_b = res
+        row_c, _ = res.all()
+        self.assertIs(row_a.author, row_b.author)
+        self.assertIsNot(row_a.author, row_c.author)
+
+    def test_columns(self):
+        author1 = AuthorFactory.create(name='Terry Pratchett', nationality=None)
+        author2 = AuthorFactory.create(name='Neil Gaiman', nationality=None)
+        for title in ('Mort', 'Eric', 'Sourcery'):
+            BookFactory.create(author=author1, title=title)
+        BookFactory.create(author=author2, title='Coraline')
+
+        # One column per expanded field and annotation, in select order
+        res = Book.objects.group_by('author').annotate(Count('id')).order_by('author__name')
+        columns = res.columns(chunk_size=1)
+        self.assertEqual(list(columns), ['author__id', 'author__name',
+                                         'author__nationality_id', 'id__count'])
+        self.assertEqual(list(columns['author__name']), ['Neil Gaiman', 'Terry Pratchett'])
+        self.assertEqual(list(columns['author__nationality_id']), [None, None])
+        self.assertEqual(list(columns['id__count']), [1, 3])
+
+        # Numeric columns are arrays (NumPy if installed), others lists
+        array_types = (array,) if numpy is None else (numpy.ndarray,)
+        self.assertIsInstance(columns['id__count'], array_types)
+        self.assertIsInstance(columns['author__id'], array_types)
+        self.assertIsInstance(columns['author__name'], list)
+        self.assertIsInstance(columns['author__nationality_id'], list)
+
+        # With subtotals and their level
+        columns = Book.objects.group_by('author', rollup=True, only=()).annotate(Count('id')).columns()
+        self.assertEqual(list(columns), ['author__id', 'id__count', 'rollup_level'])
+        self.assertEqual(list(columns['id__count']), [3, 1, 4])
+        self.assertEqual(list(columns['rollup_level']), [1, 1, 0])
+
+        # Empty results have empty columns
+        columns = res.filter(title='Small Gods').columns()
+        self.assertEqual([len(c) for c in columns.values()], [0, 0, 0, 0])
+
+        # Only for group_by querysets
+        with self.assertRaises(TypeError):
+            Book.objects.all().columns()
+
+    def test_group_by_row_factory(self):
+        author = AuthorFactory.create(name='Terry Pratchett', nationality=None)
+        BookFactory.create(author=author, title='Mort')
+        res = lambda factory: (Book.objects.group_by('title', 'author', row_factory=factory)
+                               .annotate(Count('id')))
+        names = ('title', 'author__id', 'author__name', 'author__nationality_id', 'id__count')
+        values = ('Mort', author.id, 'Terry Pratchett', None, 1)
+
+        # Built-in factories
+        row, = res(tuple_rows)
+        self.assertEqual(row, values)
+        row, = res(dict_rows)
+        self.assertEqual(row, dict(zip(names, values)))
+        row, = res(namedtuple_rows)
+        self.assertEqual(row._fields, names)
+        self.assertEqual(row.author__name, 'Terry Pratchett')
+        self.assertEqual(tuple(row), values)
+
+        # Custom factory, built once per query with the plan
+        factory = MagicMock(return_value=lambda row: row[0].upper())
+        self.assertEqual(list(res(factory)), ['MORT'])
+        plan, db, options = factory.call_args[0]
+        self.assertEqual(plan.names, names)
+        self.assertEqual(db, 'default')
+        self.assertIs(options['row_factory'], factory)
+
+    def test_cached(self):
+        cache = caches['default']
+        cache.clear()
+
+        # Generations are bumped for every model in the backends set, or used
+        # in this process, even if it hasn't cached results using the model
+        with patch('django_group_by.results.used_backends', set()):
+            before = generations(cache, [Genre])
+            GenreFactory.create(name='Horror')
+            self.assertEqual(generations(cache, [Genre]), before)
+            with self.settings(GROUP_BY_CACHES=['default']):
+                GenreFactory.create(name='Comedy')
+            self.assertNotEqual(generations(cache, [Genre]), before)
+
+        author = AuthorFactory.create(name='Terry Pratchett', nationality__name='Great Britain')
+        book = BookFactory.create(author=author, title='Mort')
+        res = Book.objects.group_by('author__nationality').annotate(Count('id')).cached()
+
+        # First evaluation queries, later ones are built from the cache
+        with self.assertNumQueries(1):
+            row, = res.all()
+        with self.assertNumQueries(0):
+            row, = res.all()
+        self.assertEqual(row.author_nationality, author.nationality)
+        self.assertEqual(row.id__count, 1)
+
+        # Different SQL (or params), different entry
+        with self.assertNumQueries(1):
+            self.assertEqual(list(res.filter(title='Eric')), [])
+
+        # Saving any model used by the query invalidates it
+        nation = author.nationality
+        nation.name = 'United Kingdom'
+        nation.save()
+        with self.assertNumQueries(1):
+            row, = res.all()
+        self.assertEqual(row.author_nationality.name, 'United Kingdom')
+        BookFactory.create(author=author, title='Eric')
+        row, = res.all()
+        self.assertEqual(row.id__count, 2)
+
+        # Including through models of joined M2M fields
+        genre = GenreFactory.create(name='Fantasy')
+        res = Book.objects.group_by('genres').annotate(Count('id')).cached()
+        self.assertEqual(len(res.all()), 1)
+        book.genres.add(genre)
+        self.assertEqual(len(res.all()), 2)
+
+        # Only for group_by querysets
+        with self.assertRaises(TypeError):
+            Book.objects.all().cached()
+
+    def test_group_by_chunk_size(self):
+        author = AuthorFactory.create(name='Terry Pratchett')
+        Book.objects.bulk_create(Book(title='Book {}'.format(i), author=author,
+                                      publication_date=datetime(2000, 1, 1))
+                                 for i in range(250))
+
+        # Same rows, fetched in chunks (option or iterator argument)
+        res = Book.objects.group_by('title', 'author').order_by('id')
+        expected = [row.title for row in res]
+        chunked = res.group_by('title', 'author', chunk_size=40).order_by('id')
+        self.assertEqual([row.title for row in chunked.iterator()], expected)
+        self.assertEqual([row.title for row in chunked], expected)
+        if django.VERSION < (1, 9) or django.VERSION >= (2, 0):
+            # Own iterator (Django 1.8) or Django's, with chunk_size argument
+            self.assertEqual([r.title for r in res.iterator(chunk_size=40)], expected)
+
+        # Empty results are fine too
+        self.assertEqual(list(chunked.none().iterator()), [])
+        self.assertEqual(list(chunked.filter(title='Mort').iterator()), [])
+
+    @skipIf(tracemalloc is None, 'tracemalloc not available')
+    def test_group_by_chunk_size_memory(self):
+        author = AuthorFactory.create(name='Terry Pratchett')
+
+        def peak_memory(count):
+            Book.objects.all().delete()
+            Book.objects.bulk_create(Book(title='Book {}'.format(i), author=author,
+                                          publication_date=datetime(2000, 1, 1))
+                                     for i in range(count))
+            res = Book.objects.group_by('title', 'author', chunk_size=100)
+            tracemalloc.start()
+            for _ in res.iterator():
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return peak
+
+        # Peak memory stays flat when rows grow by 10x (after warming up
+        # caches, unchunked it grows by 10x too on sqlite)
+        peak_memory(100)
+        small, large = peak_memory(500), peak_memory(5000)
+        self.assertLess(large, small * 2)
+
+
+class MaterializedTest(TestCase):
+
+    def setUp(self):
+        self.addCleanup(unregister, 'books')
+
+    def test_signals(self):
+        terry = AuthorFactory.create(name='Terry Pratchett')
+        neil = AuthorFactory.create(name='Neil Gaiman')
+        BookFactory.create(author=terry)
+        aggregate = register('books', Book, ['author'], {'books': Count('id'), 'total': Sum('id')})
+        aggregate.rebuild()
+
+        def current():
+            return sorted((r.author.name, r.books, r.total) for r in materialized('books'))
+        expected = sorted((r.author.name, r.books, r.total) for r in
+                          Book.objects.group_by('author').annotate(books=Count('id'), total=Sum('id')))
+        self.assertEqual(current(), expected)
+
+        # Inserts, updates (also between groups) and deletes applied incrementally
+        mort = BookFactory.create(author=terry)
+        good = BookFactory.create(author=neil)
+        good.title = 'Good Omens'
+        good.save()
+        mort.author = neil
+        mort.save()
+        good.delete()
+        expected = sorted((r.author.name, r.books, r.total) for r in
+                          Book.objects.group_by('author').annotate(books=Count('id'), total=Sum('id')))
+        self.assertEqual(current(), expected)
+
+        # Groups without rows are removed, reading doesn't query the base table
+        # (only the summaries and the related authors)
+        Book.objects.filter(author=neil).delete()
+        with self.assertNumQueries(2):
+            rows = materialized('books')
+        self.assertEqual([(r.author, r.books) for r in rows], [(terry, 1)])
+        self.assertEqual(rows[0].author.name, 'Terry Pratchett')
+
+    def test_related_rename(self):
+        terry = AuthorFactory.create(name='Terry Pratchett')
+        neil = AuthorFactory.create(name='Neil Gaiman')
+        BookFactory.create(author=terry)
+        BookFactory.create(author=neil)
+        aggregate = register('books', Book, ['author__name'], {'books': Count('id')})
+        aggregate.rebuild()
+
+        # Related columns are read when loading, renamed alike they're one group
+        terry.name = 'Sir Terry'
+        terry.save()
+        self.assertEqual(sorted((r.author.name, r.books) for r in materialized('books')),
+                         [('Neil Gaiman', 1), ('Sir Terry', 1)])
+        neil.name = 'Sir Terry'
+        neil.save()
+        self.assertEqual([(r.author.name, r.books) for r in materialized('books')],
+                         [('Sir Terry', 2)])
+
+        # Still split by author when rows change
+        BookFactory.create(author=neil)
+        self.assertEqual([(r.author.name, r.books) for r in materialized('books')],
+                         [('Sir Terry', 3)])
+        self.assertEqual(GroupSummary.objects.filter(name='books').count(), 2)
+
+    def test_concurrent_create(self):
+        register('books', Book, ['author'], {'books': Count('id')})
+        terry = AuthorFactory.create(name='Terry Pratchett')
+        first = QuerySet.first
+        missed = []
+
+        def miss_first(queryset):
+            # The group is created by another writer right after it's looked up
+            if queryset.model is GroupSummary and not missed:
+                missed.append(first(queryset))
+                return None
+            return first(queryset)
+
+        BookFactory.create(author=terry)
+        with patch.object(QuerySet, 'first', autospec=True, side_effect=miss_first):
+            BookFactory.create(author=terry)
+        self.assertIsNotNone(missed[0])
+
+        # Added to the group created meanwhile
+        self.assertEqual([(r.author.name, r.books) for r in materialized('books')],
+                         [('Terry Pratchett', 2)])
+
+    def test_catch_up(self):
+        terry = AuthorFactory.create(name='Terry Pratchett')
+        for day in (1, 2):
+            BookFactory.create(author=terry, title='Mort', publication_date=datetime(2000, 1, day))
+        qs = Book.objects.filter(title='Mort')
+        aggregate = register('books', qs, ['title', 'author'], {'books': Count('id')},
+                             timestamp='publication_date', signals=False)
+
+        # First time all groups, then only those changed after the last timestamp
+        self.assertEqual(aggregate.catch_up(), 1)
+        self.assertEqual(aggregate.catch_up(), 0)
+        Book.objects.bulk_create([Book(title='Mort', author=terry, publication_date=datetime(2000, 2, 1)),
+                                  Book(title='Eric', author=terry, publication_date=datetime(2000, 2, 1))])
+        self.assertEqual(aggregate.catch_up(), 1)
+        (row,) = aggregate.rows()
+        self.assertEqual((row.title, row.author, row.books), ('Mort', terry, 3))
+
+        # Only Count and Sum can be updated with deltas
+        self.assertRaises(ValueError, register, 'books', Book, ['author'], {'first': Min('id')})
+        self.assertRaises(ValueError, register, 'books', Book, ['author'],
+                          {'authors': Count('author', distinct=True)})
+
+
+class ParallelQuerySetTest(TransactionTestCase):
+
+    @skipIf(connection.vendor == 'sqlite' and not connection.features.can_share_in_memory_db,
+            'Threads need a shared database')
+    def test_parallel_threads(self):
+        author = AuthorFactory.create(name='Terry Pratchett')
+        Book.objects.bulk_create(Book(title='Book {}'.format(i % 7), author=author,
+                                      publication_date=datetime(2000 + i, 1, 1))
+                                 for i in range(20))
+        qs = Book.objects.group_by('title', 'author').annotate(Count('id')).order_by('title')
+
+        # Same results when run in threads, each with its connection
+        expected = [(r.title, r.author, r.id__count) for r in qs]
+        rows = qs.parallel('publication_date', workers=4)
+        self.assertEqual([(r.title, r.author, r.id__count) for r in rows], expected)
+
+    @skipIf(connection.vendor == 'sqlite' and not connection.features.can_share_in_memory_db,
+            'Threads need a shared database')
+    def test_group_by_batch_threads(self):
+        author = AuthorFactory.create(name='Terry Pratchett')
+        BookFactory.create_batch(3, author=author)
+        querysets = [Book.objects.group_by('author').annotate(Count('id')),
+                     Book.objects.group_by('title').order_by('title'),
+                     Book.objects.filter(title='Nothing').group_by('title')]
+
+        # Same results as evaluating them in turn
+        expected = [[r.__reduce__()[1] for r in qs] for qs in querysets]
+        results = group_by_batch(querysets)
+        self.assertEqual([[r.__reduce__()[1] for r in rows] for rows in results], expected)
+
+
+@skipIf(sys.version_info < (3, 6), 'async generators not available')
+class AsyncQuerySetTest(TransactionTestCase):
+
+    def setUp(self):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def collect(self, iterator, count=None):
+        # Drive the async iterator (no async syntax, for Python 2 parsing)
+        rows = []
+        while count is None or len(rows) < count:
+            try:
+                rows.append(self.loop.run_until_complete(iterator.__anext__()))
+            except StopAsyncIteration:  # noqa
+                break
+        self.loop.run_until_complete(iterator.aclose())
+        return rows
+
+    def test_async_iteration(self):
+        author = AuthorFactory.create(name='Terry Pratchett')
+        Book.objects.bulk_create(Book(title='Book {:03}'.format(i), author=author,
+                                      publication_date=datetime(2000, 1, 1))
+                                 for i in range(25))
+        res = Book.objects.group_by('title', 'author', identity_map=True).order_by('title')
+
+        # Async iteration, in chunks, same rows as sync iteration
+        rows = self.collect(res.aiterator(chunk_size=10))
+        self.assertEqual([row.title for row in rows], [row.title for row in res])
+        self.assertEqual(rows[0].author, author)
+        self.assertIs(rows[0].author, rows[-1].author)
+
+        # Await a list, also for already evaluated querysets
+        rows = self.loop.run_until_complete(res.alist())
+        self.assertEqual(len(rows), 25)
+        list(res)
+        self.assertEqual(self.loop.run_until_complete(res.alist()), res._result_cache)
+
+        # Stopping early is fine
+        row, = self.collect(res.all().__aiter__(), 1)
+        self.assertEqual(row.title, 'Book 000')